@@ -1,7 +1,12 @@
 from importlib import import_module
+import os
 from threading import RLock
 import yaml
 
+from db.log_store import FileLogStore
+from db.resource_ledger import ResourceLedger, job_requirements
+from local_docker_scheduler.constants import _LOG_STORE_DIR
+
 
 def _db_class(t):
     name = t.rsplit('.', 1)
@@ -17,4 +22,52 @@ failed_jobs = _db_class(database_dict['failed_jobs']['type'])(**database_dict['f
 completed_jobs = _db_class(database_dict['completed_jobs']['type'])(**database_dict['completed_jobs']['args'])
 running_jobs = _db_class(database_dict['running_jobs']['type'])(**database_dict['running_jobs']['args'])
 queue = _db_class(database_dict['queue']['type'])(**database_dict['queue']['args'])
-gpu_pool = {}  # TODO: This is currently thread safe based on the implementation of the peek queue and where it is being used, but NOT thread safe if anyone else touched it directly
\ No newline at end of file
+# queues that record the requirements of their jobs can pick the job to start on the server
+if hasattr(queue, 'pop_first_fit'):
+    queue.requirements = job_requirements
+# job_id -> {'state': ..., location of the job}; optional in the configuration. The in-memory default only keeps the
+# queued and running jobs, so that it does not grow with the job history; finished jobs are found by their id anyway
+if 'job_index' in database_dict:
+    job_index = _db_class(database_dict['job_index']['type'])(**database_dict['job_index']['args'])
+else:
+    job_index = {}
+_index_finished_jobs = 'job_index' in database_dict
+# container logs are kept out of the job records, which only hold a reference, the size and the tail of the logs
+if 'log_store' in database_dict:
+    log_store = _db_class(database_dict['log_store']['type'])(**database_dict['log_store']['args'])
+else:
+    log_store = FileLogStore(_LOG_STORE_DIR)
+gpu_pool = {}  # TODO: This is currently thread safe based on the implementation of the peek queue and where it is being used, but NOT thread safe if anyone else touched it directly
+# CPUs and memory of this node; defaults to the whole host
+resource_pool = ResourceLedger(os.environ.get('NODE_CPUS'), os.environ.get('NODE_MEMORY'))
+
+
+def index_job(job_id, state, **location):
+    if state in ('completed', 'failed') and not _index_finished_jobs:
+        unindex_job(job_id)
+    else:
+        job_index[job_id] = {'state': state, **location}
+
+
+def index_queued_jobs(jobs):
+    job_index.update({job['job_id']: {'state': 'queued'} for job in jobs})
+
+
+def unindex_job(job_id):
+    try:
+        del job_index[job_id]
+    except KeyError:
+        pass
+
+
+# stores without the bulk read methods (plain dicts, SqliteDict) fall back to the mapping interface
+def get_or_none(store, key):
+    if hasattr(store, 'get_or_none'):
+        return store.get_or_none(key)
+    return store.get(key)
+
+
+def iter_items(store):
+    if hasattr(store, 'iter_items'):
+        return store.iter_items()
+    return store.items()
@@ -0,0 +1,32 @@
+from functools import cmp_to_key
+
+
+def filter_jobs(items, project=None, user=None, since=None, until=None, status_code=None, sort=(), offset=0, limit=None):
+    def matches(job):
+        metadata = job.get('metadata', {})
+        end_time = job.get('end_time')
+        return (project is None or metadata.get('project_name') == project) \
+            and (user is None or metadata.get('username') == user) \
+            and (since is None or (end_time is not None and end_time >= since)) \
+            and (until is None or (end_time is not None and end_time < until)) \
+            and (status_code is None or (job.get('return_code') or {}).get('StatusCode') == status_code)
+
+    def compare(left, right):
+        for field, descending in sort:
+            left_value, right_value = job_field(left[1], field), job_field(right[1], field)
+            if left_value != right_value:
+                result = -1 if left_value < right_value else 1
+                return -result if descending else result
+        return 0
+
+    jobs = [(job_id, job) for job_id, job in items if matches(job)]
+    if sort:
+        jobs.sort(key=cmp_to_key(compare))
+    return jobs[offset:offset + limit if limit is not None else None]
+
+
+def job_field(job, field):
+    # dotted fields reach into nested values, e.g. return_code.StatusCode
+    for name in field.split('.'):
+        job = job[name]
+    return job
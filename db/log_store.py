@@ -0,0 +1,45 @@
+import os
+import os.path as path
+
+
+class FileLogStore:
+    def __init__(self, directory, tail_size=4096):
+        self._directory = directory
+        self._tail_size = tail_size
+
+    def _path(self, job_id):
+        return path.join(self._directory, f'{job_id}.log')
+
+    def save(self, job_id, chunks):
+        # accepts the whole log or an iterable of chunks so that logs can be streamed to disk
+        if isinstance(chunks, (bytes, str)):
+            chunks = [chunks]
+
+        os.makedirs(self._directory, exist_ok=True)
+        log_path = self._path(job_id)
+        size = 0
+        tail = b''
+
+        with open(f'{log_path}.tmp', 'wb') as log_file:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                log_file.write(chunk)
+                size += len(chunk)
+                tail = (tail + chunk)[-self._tail_size:]
+        os.replace(f'{log_path}.tmp', log_path)
+
+        return {'logs': tail.decode(errors='replace'), 'log_ref': {'path': log_path, 'size': size}}
+
+    def load(self, job_id):
+        try:
+            with open(self._path(job_id), 'rb') as log_file:
+                return log_file.read().decode(errors='replace')
+        except FileNotFoundError:
+            return None
+
+    def __delitem__(self, job_id):
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            raise KeyError(job_id)
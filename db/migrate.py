@@ -0,0 +1,17 @@
+import logging
+
+import db
+
+
+def migrate():
+    # converts the existing entries of every store that supports it to the codec configured in database.config.yaml
+    for name in ['queue', 'running_jobs', 'completed_jobs', 'failed_jobs', 'job_index']:
+        store = getattr(db, name)
+        if hasattr(store, 'migrate'):
+            logging.info(f"Migrating {name}...")
+            logging.info(f"Migrated {store.migrate()} entries of {name}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+    migrate()
@@ -1,54 +1,449 @@
+import os
+from threading import Lock
+
 import redis
-from pickle import loads, dumps
+
+from db.serialization import Codec
+
+
+# every client of the same Redis server shares one bounded pool; callers block for a free connection instead of
+# opening new ones as worker threads are added
+_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 20))
+_SOCKET_TIMEOUT = float(os.environ['REDIS_SOCKET_TIMEOUT']) if 'REDIS_SOCKET_TIMEOUT' in os.environ else None
+_SOCKET_CONNECT_TIMEOUT = float(os.environ.get('REDIS_SOCKET_CONNECT_TIMEOUT', 5))
+_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
+# REDIS_UNIX_SOCKET is the socket of the server at REDIS_HOST:REDIS_PORT; other servers are still reached over TCP
+_UNIX_SOCKET = os.environ.get('REDIS_UNIX_SOCKET', None)
+_UNIX_SOCKET_SERVER = (os.environ.get('REDIS_HOST'), os.environ.get('REDIS_PORT') or '6379')
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def _unix_socket_of(host, port):
+    if _UNIX_SOCKET and (str(host), str(port)) == _UNIX_SOCKET_SERVER:
+        return _UNIX_SOCKET
+    return None
+
+
+def connection_pool(host, port, db=0, unix_socket=None):
+    unix_socket = unix_socket or _unix_socket_of(host, port)
+    key = (unix_socket or host, None if unix_socket else int(port), int(db))
+    with _pools_lock:
+        if key not in _pools:
+            kwargs = {'db': int(db), 'max_connections': _MAX_CONNECTIONS, 'timeout': _POOL_TIMEOUT,
+                      'socket_timeout': _SOCKET_TIMEOUT, 'socket_connect_timeout': _SOCKET_CONNECT_TIMEOUT,
+                      'health_check_interval': _HEALTH_CHECK_INTERVAL}
+            if unix_socket:
+                del kwargs['socket_connect_timeout']
+                kwargs.update(connection_class=redis.UnixDomainSocketConnection, path=unix_socket)
+            else:
+                kwargs.update(host=host, port=int(port))
+            _pools[key] = redis.BlockingConnectionPool(**kwargs)
+        return _pools[key]
+
+
+def connect(host, port, db=0, unix_socket=None):
+    return redis.StrictRedis(connection_pool=connection_pool(host, port, db, unix_socket))
+
+
+# The queue is stored as a sorted set of item ids (ordered by score) plus a hash of id -> payload so that positional
+# operations only touch small ids and identical payloads stay distinct. The scripts below keep both in sync atomically.
+# KEYS are always: order (sorted set), items (hash), sequence (id counter), requirements (hash of id -> "gpus cpus
+# memory" or "invalid", recorded when the list is given a requirements function; an empty string records nothing)
+
+_APPEND = """
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+local score = 0
+if last[2] then
+    score = tonumber(last[2]) + 1
+end
+for i = 1, #ARGV, 2 do
+    local id = redis.call('INCR', KEYS[3])
+    redis.call('ZADD', KEYS[1], score, id)
+    redis.call('HSET', KEYS[2], id, ARGV[i])
+    if ARGV[i + 1] ~= '' then
+        redis.call('HSET', KEYS[4], id, ARGV[i + 1])
+    end
+    score = score + 1
+end
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# score placing an item right before the one currently at index; nil if there is nothing at index
+_SCORE_BEFORE = """
+local function score_before(index)
+    local at = redis.call('ZRANGE', KEYS[1], index, index, 'WITHSCORES')
+    if not at[1] then
+        return nil
+    end
+    local rank = redis.call('ZRANK', KEYS[1], at[1])
+    local after = tonumber(at[2])
+    local before = after - 1
+    if rank > 0 then
+        before = tonumber(redis.call('ZRANGE', KEYS[1], rank - 1, rank - 1, 'WITHSCORES')[2])
+    end
+    local score = (before + after) / 2
+    if score > before and score < after then
+        return score
+    end
+    -- repeated insertions exhausted the precision between the two neighbours; spread the scores out again
+    for i, id in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+        redis.call('ZADD', KEYS[1], i - 1, id)
+    end
+    return rank - 0.5
+end
+"""
+
+_INSERT = _SCORE_BEFORE + """
+local score = score_before(ARGV[1])
+if not score then
+    return nil
+end
+local id = redis.call('INCR', KEYS[3])
+redis.call('ZADD', KEYS[1], score, id)
+redis.call('HSET', KEYS[2], id, ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[4], id, ARGV[3])
+end
+return id
+"""
+
+_REPOSITION = _SCORE_BEFORE + """
+local moved = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[1], 'WITHSCORES')
+if not moved[1] then
+    return nil
+end
+redis.call('ZREM', KEYS[1], moved[1])
+local score = score_before(ARGV[2])
+if not score then
+    redis.call('ZADD', KEYS[1], moved[2], moved[1])
+    return nil
+end
+redis.call('ZADD', KEYS[1], score, moved[1])
+return moved[1]
+"""
+
+_GET = """
+local id = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[1])[1]
+if not id then
+    return nil
+end
+return redis.call('HGET', KEYS[2], id)
+"""
+
+_RANGE = """
+local values = {}
+for i, id in ipairs(redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[2])) do
+    values[i] = redis.call('HGET', KEYS[2], id)
+end
+return values
+"""
+
+_RANGE_WITH_IDS = """
+local items = {}
+for i, id in ipairs(redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[2])) do
+    items[2 * i - 1] = id
+    items[2 * i] = redis.call('HGET', KEYS[2], id)
+end
+return items
+"""
+
+_SET = """
+local id = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[1])[1]
+if not id then
+    return nil
+end
+redis.call('HSET', KEYS[2], id, ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[4], id, ARGV[3])
+else
+    redis.call('HDEL', KEYS[4], id)
+end
+return id
+"""
+
+_POP = """
+local id = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[1])[1]
+if not id then
+    return nil
+end
+local value = redis.call('HGET', KEYS[2], id)
+redis.call('ZREM', KEYS[1], id)
+redis.call('HDEL', KEYS[2], id)
+redis.call('HDEL', KEYS[4], id)
+return value
+"""
+
+_POP_ID = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return nil
+end
+local value = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+return value
+"""
+
+_RECORD_REQUIREMENTS = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return nil
+end
+return redis.call('HSET', KEYS[4], ARGV[1], ARGV[2])
+"""
+
+# Pops the first item of the window whose recorded requirements fit the free amounts, in a single step so that
+# schedulers sharing the queue never take the same item. The head is taken when it fits; otherwise the fitting item
+# taking the largest share of the free amounts wins, unless the head is ARGV[8] (blocked from being skipped).
+# Invalid items and items over the capacity are popped right away so that they can be failed.
+# ARGV: window, then free and capacity of GPUs, CPUs and memory in turn (-1 is unlimited), blocked head id
+# Returns {status, id, value, head id}; 'unknown' asks the caller to record the requirements of the item first
+_POP_FIRST_FIT = """
+local ids = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if not ids[1] then
+    return {'empty'}
+end
+local free = {tonumber(ARGV[2]), tonumber(ARGV[4]), tonumber(ARGV[6])}
+local capacity = {tonumber(ARGV[3]), tonumber(ARGV[5]), tonumber(ARGV[7])}
+
+local function pop(status, id)
+    local value = redis.call('HGET', KEYS[2], id)
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('HDEL', KEYS[2], id)
+    redis.call('HDEL', KEYS[4], id)
+    return {status, id, value, ids[1]}
+end
+
+local best, best_score
+for position, id in ipairs(ids) do
+    local recorded = redis.call('HGET', KEYS[4], id)
+    if not recorded then
+        return {'unknown', id, redis.call('HGET', KEYS[2], id), ids[1]}
+    end
+    if recorded == 'invalid' then
+        return pop('invalid', id)
+    end
+
+    local required = {}
+    for amount in string.gmatch(recorded, '%S+') do
+        required[#required + 1] = tonumber(amount)
+    end
+    local fits = true
+    local score = 0
+    for i = 1, 3 do
+        if capacity[i] >= 0 and required[i] > capacity[i] then
+            return pop('invalid', id)
+        end
+        if free[i] >= 0 then
+            if required[i] > free[i] then
+                fits = false
+            elseif required[i] > 0 then
+                score = score + required[i] / free[i]
+            end
+        end
+    end
+
+    if fits then
+        if position == 1 then
+            return pop('job', id)
+        end
+        if not best_score or score > best_score then
+            best, best_score = id, score
+        end
+    end
+end
+
+if not best or ids[1] == ARGV[8] then
+    return {'none', false, false, ids[1]}
+end
+return pop('job', best)
+"""
+
+# converts a queue stored as a plain Redis list (KEYS[5]) by earlier versions; the requirements of the converted items
+# are recorded the first time pop_first_fit sees them
+_MIGRATE_LIST = """
+if redis.call('TYPE', KEYS[5])['ok'] ~= 'list' then
+    return 0
+end
+local values = redis.call('LRANGE', KEYS[5], 0, -1)
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+local score = 0
+if last[2] then
+    score = tonumber(last[2]) + 1
+end
+for _, value in ipairs(values) do
+    local id = redis.call('INCR', KEYS[3])
+    redis.call('ZADD', KEYS[1], score, id)
+    redis.call('HSET', KEYS[2], id, value)
+    score = score + 1
+end
+redis.call('DEL', KEYS[5])
+return #values
+"""
 
 
 class RedisDict:
-    def __init__(self, key, host, port, db=0):
-        self._redis = redis.StrictRedis(host, port, db)
+    def __init__(self, key, host, port, db=0, codec=None, unix_socket=None):
+        self._redis = connect(host, port, db, unix_socket)
         # try the connection; allow user of class to handle exception themselves
         self._redis.ping()
         self._key = key
+        self._codec = Codec(**(codec or {}))
 
     def __getitem__(self, field):
-        response = self._redis.hget(self._key, dumps(field))
+        response = self._redis.hget(self._key, self._codec.dump_field(field))
         if response is None:
             raise KeyError(f'Key: {self._key} not found')
-        return loads(response)
+        return self._codec.loads(response)
 
     def __setitem__(self, field, value):
-        return self._redis.hset(self._key, dumps(field), dumps(value))
+        return self._redis.hset(self._key, self._codec.dump_field(field), self._codec.dumps(value))
+
+    def update(self, mapping):
+        if mapping:
+            return self._redis.hmset(self._key, {self._codec.dump_field(field): self._codec.dumps(value)
+                                                 for field, value in mapping.items()})
+
+    def get_or_none(self, field):
+        response = self._redis.hget(self._key, self._codec.dump_field(field))
+        return None if response is None else self._codec.loads(response)
+
+    def get_many(self, fields):
+        # one HMGET for all fields; missing fields are left out
+        fields = list(fields)
+        if not fields:
+            return {}
+        responses = self._redis.hmget(self._key, [self._codec.dump_field(field) for field in fields])
+        return {field: self._codec.loads(response) for field, response in zip(fields, responses) if response is not None}
 
     def items(self):
-        return [(loads(field), loads(value)) for field, value in self._redis.hgetall(self._key).items()]
+        return [(self._codec.load_field(field), self._codec.loads(value))
+                for field, value in self._redis.hgetall(self._key).items()]
+
+    def iter_items(self, batch=500):
+        # HSCAN keeps Redis responsive for large hashes; entries changed during the scan may be seen twice or not at all
+        for field, value in self._redis.hscan_iter(self._key, count=batch):
+            yield self._codec.load_field(field), self._codec.loads(value)
 
     def keys(self):
-        return [loads(field) for field in self._redis.hkeys(self._key)]
+        return [self._codec.load_field(field) for field in self._redis.hkeys(self._key)]
 
     def __delitem__(self, field):
-        return self._redis.hdel(self._key, dumps(field))
+        return self._redis.hdel(self._key, self._codec.dump_field(field))
 
     def __contains__(self, field):
-        return self._redis.hexists(self._key, dumps(field)) == 1
+        return self._redis.hexists(self._key, self._codec.dump_field(field)) == 1
+
+    def migrate(self, batch_size=500):
+        # rewrites every field and value with the configured codec
+        pipeline = self._redis.pipeline(transaction=False)
+        migrated = 0
+        for field, value in self._redis.hscan_iter(self._key, count=batch_size):
+            new_field = self._codec.dump_field(self._codec.load_field(field))
+            if isinstance(new_field, str):
+                new_field = new_field.encode()
+            if new_field != field:
+                pipeline.hdel(self._key, field)
+            pipeline.hset(self._key, new_field, self._codec.dumps(self._codec.loads(value)))
+
+            migrated += 1
+            if migrated % batch_size == 0:
+                pipeline.execute()
+        pipeline.execute()
+        return migrated
 
 
 class RedisList:
-    def __init__(self, key, host, port, db=0):
-        self._redis = redis.StrictRedis(host, port, db)
+    def __init__(self, key, host, port, db=0, codec=None, unix_socket=None):
+        self._redis = connect(host, port, db, unix_socket)
         # try the connection; allow user of class to handle exception themselves
         self._redis.ping()
         self._key = key
+        self._codec = Codec(**(codec or {}))
+        self._keys = [f'{key}:order', f'{key}:items', f'{key}:sequence', f'{key}:requirements']
+        self._channel = f'{key}:events'
+        self._scripts = {name: self._redis.register_script(script) for name, script in
+                         [('append', _APPEND), ('insert', _INSERT), ('reposition', _REPOSITION), ('get', _GET),
+                          ('range', _RANGE), ('range_with_ids', _RANGE_WITH_IDS), ('set', _SET),
+                          ('pop', _POP), ('pop_id', _POP_ID), ('record_requirements', _RECORD_REQUIREMENTS),
+                          ('pop_first_fit', _POP_FIRST_FIT)]}
+        # function returning the (gpus, cpus, memory) of an item, or raising ValueError; used by pop_first_fit
+        self.requirements = None
+
+        self._redis.register_script(_MIGRATE_LIST)(keys=self._keys + [key])
+
+    def _run(self, script, *args, client=None):
+        return self._scripts[script](keys=self._keys, args=args, client=client)
+
+    def _dumps(self, value):
+        return self._codec.dumps(value)
+
+    def _loads(self, response):
+        return self._codec.loads(response)
+
+    def _requirements_of(self, value):
+        if self.requirements is None:
+            return ''
+        try:
+            return '{} {} {}'.format(*self.requirements(value))
+        except ValueError:
+            return 'invalid'
+
+    def _notify(self, script, event, *args):
+        pipeline = self._redis.pipeline(transaction=False)
+        self._run(script, *args, client=pipeline)
+        pipeline.publish(self._channel, event)
+        return pipeline.execute()[0]
+
+    def subscribe(self, callback, sleep_time=1):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self._channel: lambda message: callback()})
+        return pubsub.run_in_thread(sleep_time=sleep_time, daemon=True)
+
+    def __len__(self):
+        return self._redis.zcard(self._keys[0])
 
     def __getitem__(self, index):
-        response = self._redis.lindex(self._key, index)
+        if isinstance(index, slice):
+            return self._slice(index)
+
+        response = self._run('get', index)
         if response is None:
             raise IndexError
-        return loads(response)
+        return self._loads(response)
+
+    def _slice(self, index):
+        if index.step not in (None, 1):
+            raise ValueError('RedisList slices do not support steps')
+
+        start = index.start or 0
+        # ZRANGE bounds are inclusive
+        if index.stop is None:
+            stop = -1
+        elif index.stop == 0:
+            return []
+        else:
+            stop = index.stop - 1
+
+        return [self._loads(value) for value in self._run('range', start, stop)]
+
+    def __iter__(self, batch_size=500):
+        offset = 0
+        while True:
+            values = self[offset:offset + batch_size]
+            yield from values
+            if len(values) < batch_size:
+                return
+            offset += batch_size
 
     def __setitem__(self, index, value):
-        return self._redis.lset(self._key, index, dumps(value))
+        if self._run('set', index, self._dumps(value), self._requirements_of(value)) is None:
+            raise IndexError
 
     def __delitem__(self, index):
-        return self._redis.lrem(self._key, 1, dumps(self.__getitem__(index)))
+        if self._notify('pop', 'remove', index) is None:
+            raise IndexError
 
     def __contains__(self, value):
         print(f"looking up {value} in {self._key}")
@@ -59,35 +454,66 @@ class RedisList:
             return False
 
     def insert(self, index, value):
-        return self._redis.linsert(self._key, "before", dumps(self.__getitem__(index)), dumps(value))
+        if self._notify('insert', 'insert', index, self._dumps(value), self._requirements_of(value)) is None:
+            raise IndexError
 
     def append(self, value):
-        return self._redis.rpush(self._key, dumps(value))
+        return self._notify('append', 'append', self._dumps(value), self._requirements_of(value))
+
+    def extend(self, values):
+        args = [arg for value in values for arg in (self._dumps(value), self._requirements_of(value))]
+        if args:
+            return self._notify('append', 'append', *args)
 
     def peek(self, index=0):
         return self.__getitem__(index)
 
     def pop(self, index=-1):
-        if index == -1:
-            response = self._redis.rpop(self._key)
-            if response is None:
-                raise IndexError
-            return loads(response)
-        elif index == 0:
-            response = self._redis.lpop(self._key)
-            if response is None:
+        response = self._notify('pop', 'remove', index)
+        if response is None:
+            raise IndexError
+        return self._loads(response)
+
+    def window(self, size):
+        # the first size items with their ids, so that one of them can be popped even if the queue changes meanwhile
+        response = self._run('range_with_ids', 0, size - 1)
+        return [(response[i], self._loads(response[i + 1])) for i in range(0, len(response), 2)]
+
+    def pop_item(self, item_id):
+        # returns None if the item is no longer queued
+        response = self._run('pop_id', item_id)
+        return self._loads(response) if response is not None else None
+
+    def pop_first_fit(self, window, free, capacity, blocked_head=None):
+        # free and capacity are (gpus, cpus, memory); None or inf is unlimited. Returns the popped value, or None if
+        # nothing fits, and the id of the head if a fitting item was taken in front of it. Raises IndexError if empty
+        amounts = [-1 if amount is None or amount == float('inf') else amount
+                   for pair in zip(free, capacity) for amount in pair]
+        while True:
+            status, item_id, value, head_id = (self._run('pop_first_fit', window, *amounts, blocked_head or '') +
+                                               [None] * 3)[:4]
+            if status == b'empty':
                 raise IndexError
-            return loads(response)
-        else:
-            response = self[index]
-            del self[index]
-            return response
+            if status == b'none':
+                return None, head_id
+            if status != b'unknown':
+                return self._loads(value), head_id if status == b'job' and item_id != head_id else None
+
+            self._run('record_requirements', item_id, self._requirements_of(self._loads(value)) or 'invalid')
+
+    def migrate(self, batch_size=500):
+        # rewrites every queued item with the configured codec, keeping ids and positions
+        pipeline = self._redis.pipeline(transaction=False)
+        migrated = 0
+        for item_id, value in self._redis.hscan_iter(self._keys[1], count=batch_size):
+            pipeline.hset(self._keys[1], item_id, self._dumps(self._loads(value)))
+
+            migrated += 1
+            if migrated % batch_size == 0:
+                pipeline.execute()
+        pipeline.execute()
+        return migrated
 
     def reposition(self, original_position, new_position):
-        temp = self[original_position]
-        del self[original_position]
-        try:
-            self.insert(new_position, temp)
-        except IndexError:
-            self.insert(original_position, temp)
-            raise
+        if self._notify('reposition', 'reposition', original_position, new_position) is None:
+            raise IndexError
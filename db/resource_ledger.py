@@ -0,0 +1,89 @@
+import os
+import re
+from threading import Lock
+
+
+_MEMORY_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_memory(value):
+    # bytes, or a docker style size such as '512m' or '4g'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)b?\s*', str(value).lower())
+    if match is None:
+        raise ValueError(f"Invalid memory size {value!r}")
+    return int(float(match.group(1)) * _MEMORY_UNITS[match.group(2)])
+
+
+def job_requirements(job):
+    # GPUs, CPUs and memory a job asks for; CPUs and memory are declared in the resource spec, or taken from the
+    # limits of the container spec
+    num_gpus = job.get("gpu_spec", {}).get("num_gpus", 0)
+    try:
+        num_gpus = int(num_gpus)
+    except ValueError:
+        raise ValueError(f"Foundations ERROR: Job '{job['job_id']}' was given a value that could not be converted to an integer for GPUs usage ({num_gpus})")
+    if num_gpus < 0:
+        raise ValueError(f"Foundations ERROR: Job '{job['job_id']}' expects an invalid number of GPUs ({num_gpus})")
+
+    resource_spec = job.get('resource_spec') or {}
+    spec = job.get('spec') or {}
+    cpus = resource_spec.get('cpus', (spec.get('nano_cpus') or 0) / 1e9)
+    memory = resource_spec.get('memory', spec.get('mem_limit') or 0)
+    try:
+        cpus, memory = float(cpus), parse_memory(memory)
+    except (TypeError, ValueError):
+        raise ValueError(f"Foundations ERROR: Job '{job['job_id']}' was given an invalid CPU or memory request ({cpus} CPUs, {memory} memory)")
+    if cpus < 0 or memory < 0:
+        raise ValueError(f"Foundations ERROR: Job '{job['job_id']}' expects an invalid amount of CPUs or memory ({cpus} CPUs, {memory} bytes)")
+
+    return num_gpus, cpus, memory
+
+
+def _host_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+class ResourceLedger:
+    # CPUs and memory reserved by the jobs running on this node; a capacity of 0 is not accounted
+    def __init__(self, cpus=None, memory=None):
+        self.cpus = float(cpus) if cpus is not None else float(os.cpu_count() or 0)
+        self.memory = parse_memory(memory) if memory is not None else _host_memory()
+        self._lock = Lock()
+        # job_id -> (cpus, memory)
+        self._reservations = {}
+
+    def used(self):
+        with self._lock:
+            return (sum(cpus for cpus, _ in self._reservations.values()),
+                    sum(memory for _, memory in self._reservations.values()))
+
+    def free(self):
+        used_cpus, used_memory = self.used()
+        return (self.cpus - used_cpus if self.cpus else float('inf'),
+                self.memory - used_memory if self.memory else float('inf'))
+
+    def exceeds_capacity(self, cpus, memory):
+        return bool(self.cpus and cpus > self.cpus or self.memory and memory > self.memory)
+
+    def fits(self, cpus, memory):
+        free_cpus, free_memory = self.free()
+        return cpus <= free_cpus and memory <= free_memory
+
+    def reserve(self, job_id, cpus, memory):
+        with self._lock:
+            self._reservations[job_id] = (cpus, memory)
+
+    def release(self, job_id):
+        with self._lock:
+            self._reservations.pop(job_id, None)
+
+    def status(self):
+        used_cpus, used_memory = self.used()
+        return {'cpus': self.cpus, 'memory': self.memory, 'used_cpus': used_cpus, 'used_memory': used_memory,
+                'jobs': len(self._reservations)}
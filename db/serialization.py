@@ -0,0 +1,69 @@
+import json
+from pickle import loads as pickle_loads, dumps as pickle_dumps
+
+
+# every payload starts with a tag naming its format so that payloads written with different codecs can be read
+# side by side; pickles (protocol 2 and up) already start with their own opcode
+_PICKLE = b'\x80'
+_JSON = b'j'
+_MSGPACK = b'm'
+_ZSTD = b'z'
+
+
+class Codec:
+    def __init__(self, format='pickle', compression=None, compression_level=3):
+        if format not in ('pickle', 'json', 'msgpack'):
+            raise ValueError(f'Unknown serialization format {format}')
+        if compression not in (None, 'zstd'):
+            raise ValueError(f'Unknown compression {compression}')
+
+        # fail at start up rather than on the first write if an optional dependency is missing
+        if format == 'msgpack':
+            import msgpack
+        if compression == 'zstd':
+            import zstandard
+
+        self._format = format
+        self._compression = compression
+        self._compression_level = compression_level
+
+    @property
+    def plain_fields(self):
+        return self._format != 'pickle'
+
+    def dumps(self, value):
+        if self._format == 'json':
+            data = _JSON + json.dumps(value, separators=(',', ':')).encode()
+        elif self._format == 'msgpack':
+            import msgpack
+            data = _MSGPACK + msgpack.packb(value, use_bin_type=True)
+        else:
+            data = pickle_dumps(value)
+
+        if self._compression == 'zstd':
+            import zstandard
+            data = _ZSTD + zstandard.ZstdCompressor(level=self._compression_level).compress(data)
+
+        return data
+
+    @staticmethod
+    def loads(data):
+        if data[:1] == _ZSTD:
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompress(data[1:])
+
+        if data[:1] == _JSON:
+            return json.loads(data[1:])
+        if data[:1] == _MSGPACK:
+            import msgpack
+            return msgpack.unpackb(data[1:], raw=False)
+        return pickle_loads(data)
+
+    def dump_field(self, field):
+        return str(field) if self.plain_fields else pickle_dumps(field)
+
+    @staticmethod
+    def load_field(field):
+        if field[:1] == _PICKLE:
+            return pickle_loads(field)
+        return field.decode()
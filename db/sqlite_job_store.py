@@ -0,0 +1,159 @@
+import atexit
+import sqlite3
+from pickle import loads, dumps
+from threading import RLock, Thread, Event
+
+from db.job_query import filter_jobs
+
+
+# job record fields that can be filtered and sorted on inside SQLite
+_COLUMNS = {
+    'job_id': 'job_id',
+    'metadata.project_name': 'project',
+    'metadata.username': 'user',
+    'queued_time': 'queued_time',
+    'start_time': 'start_time',
+    'end_time': 'end_time',
+    'return_code.StatusCode': 'return_code',
+}
+
+
+class SqliteJobStore:
+    def __init__(self, location, table, state=None, commit_batch_size=100, commit_interval=1.0):
+        self._table = table
+        self._state = state
+        self._commit_batch_size = commit_batch_size
+        self._lock = RLock()
+        self._pending_writes = 0
+
+        self._connection = sqlite3.connect(location, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ('
+                                 'job_id TEXT PRIMARY KEY, project TEXT, user TEXT, state TEXT, '
+                                 'queued_time REAL, start_time REAL, end_time REAL, return_code INTEGER, record BLOB)')
+        for column in ['project', 'user', 'end_time', 'return_code']:
+            self._connection.execute(f'CREATE INDEX IF NOT EXISTS "{table}_{column}" ON "{table}" ({column})')
+        self._connection.commit()
+
+        self._closed = Event()
+        Thread(target=self._commit_periodically, args=[commit_interval], daemon=True).start()
+        atexit.register(self.close)
+
+    def _commit_periodically(self, interval):
+        while not self._closed.wait(interval):
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            if self._pending_writes and not self._closed.is_set():
+                self._connection.commit()
+                self._pending_writes = 0
+
+    def close(self):
+        # also runs at exit, possibly after an explicit close
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            self._connection.commit()
+            self._connection.close()
+            self._pending_writes = 0
+
+    def _write(self, statement, parameters):
+        with self._lock:
+            cursor = self._connection.executemany(statement, parameters)
+            self._pending_writes += 1
+            if self._pending_writes >= self._commit_batch_size:
+                self.commit()
+            return cursor
+
+    def _row(self, job_id, job):
+        metadata = job.get('metadata', {})
+        return_code = job.get('return_code') or {}
+        state = self._state or ('completed' if return_code.get('StatusCode') == 0 else 'failed')
+        return (job_id, metadata.get('project_name'), metadata.get('username'), state, job.get('queued_time'),
+                job.get('start_time'), job.get('end_time'), return_code.get('StatusCode'), dumps(job))
+
+    def _read(self, statement, parameters=()):
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def __getitem__(self, job_id):
+        rows = self._read(f'SELECT record FROM "{self._table}" WHERE job_id = ?', (job_id,))
+        if not rows:
+            raise KeyError(job_id)
+        return loads(rows[0][0])
+
+    def get_or_none(self, job_id):
+        try:
+            return self[job_id]
+        except KeyError:
+            return None
+
+    def get_many(self, job_ids):
+        job_ids = list(job_ids)
+        if not job_ids:
+            return {}
+        statement = f'SELECT job_id, record FROM "{self._table}" WHERE job_id IN ({", ".join("?" * len(job_ids))})'
+        return {job_id: loads(record) for job_id, record in self._read(statement, job_ids)}
+
+    def __setitem__(self, job_id, job):
+        self.update({job_id: job})
+
+    def update(self, mapping):
+        self._write(f'INSERT OR REPLACE INTO "{self._table}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [self._row(job_id, job) for job_id, job in mapping.items()])
+
+    def __delitem__(self, job_id):
+        if self._write(f'DELETE FROM "{self._table}" WHERE job_id = ?', [(job_id,)]).rowcount == 0:
+            raise KeyError(job_id)
+
+    def __contains__(self, job_id):
+        return bool(self._read(f'SELECT 1 FROM "{self._table}" WHERE job_id = ?', (job_id,)))
+
+    def __len__(self):
+        return self._read(f'SELECT COUNT(*) FROM "{self._table}"')[0][0]
+
+    def keys(self):
+        return [job_id for job_id, in self._read(f'SELECT job_id FROM "{self._table}"')]
+
+    def items(self):
+        return [(job_id, loads(record)) for job_id, record in self._read(f'SELECT job_id, record FROM "{self._table}"')]
+
+    def iter_items(self, batch=500):
+        # pages through the primary key so that only one batch of records is unpickled at a time
+        rows = self._read(f'SELECT job_id, record FROM "{self._table}" ORDER BY job_id LIMIT ?', (batch,))
+        while True:
+            for job_id, record in rows:
+                yield job_id, loads(record)
+            if len(rows) < batch:
+                return
+            rows = self._read(f'SELECT job_id, record FROM "{self._table}" WHERE job_id > ? ORDER BY job_id LIMIT ?',
+                              (rows[-1][0], batch))
+
+    def query(self, project=None, user=None, since=None, until=None, status_code=None, sort=(), offset=0, limit=None):
+        conditions, parameters = [], []
+        for condition, value in [('project = ?', project), ('user = ?', user), ('end_time >= ?', since),
+                                 ('end_time < ?', until), ('return_code = ?', status_code)]:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        statement = f'SELECT job_id, record FROM "{self._table}"'
+        if conditions:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+
+        if any(field not in _COLUMNS for field, _ in sort):
+            # sorting on fields without a column happens in Python on the filtered rows
+            rows = [(job_id, loads(record)) for job_id, record in self._read(statement, parameters)]
+            return filter_jobs(rows, sort=sort, offset=offset, limit=limit)
+
+        if sort:
+            statement += ' ORDER BY ' + ', '.join(f'{_COLUMNS[field]} {"DESC" if descending else "ASC"}'
+                                                  for field, descending in sort)
+        if limit is not None or offset:
+            statement += ' LIMIT ? OFFSET ?'
+            parameters += [limit if limit is not None else -1, offset]
+
+        return [(job_id, loads(record)) for job_id, record in self._read(statement, parameters)]
@@ -1,25 +1,82 @@
 import logging
 import copy
 import os
-from time import time
+from time import time, sleep
 import os.path as path
 
 import docker
 from docker.types import LogConfig
 from docker.errors import APIError
-import tarfile
+from threading import Condition, Thread
 
-from db import queue, running_jobs, completed_jobs, failed_jobs, peek_lock, gpu_pool, RLock
+from db import queue, running_jobs, completed_jobs, failed_jobs, peek_lock, gpu_pool, RLock, index_job, log_store, \
+    iter_items, resource_pool
+from db.resource_ledger import parse_memory, job_requirements
 from local_docker_scheduler import get_app
 from tracker_client_plugins import tracker_clients
 from reverse_proxy import routing_map, my_url
-from local_docker_scheduler.constants import _WORKING_DIR, _JOB_BUNDLE_STORE_DIR
+from local_docker_scheduler.constants import _WORKING_DIR
+from local_docker_scheduler.job_bundle_store import job_bundle_store
+from local_docker_scheduler.artifact_archive import remove_cached_archives
+from docker_worker_pool.image_cache import ImageCache, normalize_image
 
 
 _workers = {}
 _interval = 2
+_dispatch_mode = os.environ.get('DISPATCH_MODE', 'poll')
+_idle_interval = int(os.environ.get('WORKER_IDLE_INTERVAL', 60))
+_dispatch_condition = Condition(RLock())
+_queue_generation = 0
+_queue_subscription = None
+_dispatcher_thread = None
 _cron_workers = {}
+# with a window of 1 the queue is strictly FIFO; larger windows let jobs behind a head that does not fit start first,
+# until the head has been passed over ADMISSION_MAX_SKIPS times
+_admission_window = max(int(os.environ.get('ADMISSION_WINDOW', 1)), 1)
+_admission_max_skips = int(os.environ.get('ADMISSION_MAX_SKIPS', 10))
+_skipped_head = [None, 0]
 _max_cron_workers = 10
+# every worker shares one Docker client; running jobs each keep a connection open while waiting on their container
+_docker_timeout = int(os.environ.get('DOCKER_TIMEOUT', 60))
+_docker_max_pool_size = int(os.environ.get('DOCKER_MAX_POOL_SIZE',
+                                           int(os.environ.get('NUM_WORKERS', 1)) + _max_cron_workers + 10))
+_docker_client = None
+_streaming_docker_client = None
+_docker_client_lock = RLock()
+_image_prepull = os.environ.get('IMAGE_PREPULL', 'true').lower() == 'true'
+_image_cache_max_bytes = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 0))
+_image_gc_interval = int(os.environ.get('IMAGE_GC_INTERVAL', 600))
+# 'wait' keeps a worker thread blocked on each running container; 'events' frees the thread once the container has
+# started and finishes jobs from the Docker event stream
+_container_wait_mode = os.environ.get('CONTAINER_WAIT_MODE', 'wait')
+_JOB_ID_LABEL = 'local_docker_scheduler.job_id'
+_WORKER_ID_LABEL = 'local_docker_scheduler.worker_id'
+# container id -> (worker, gpu ids, remove working dir)
+_watched_containers = {}
+_watch_lock = RLock()
+_watcher_thread = None
+_finishing_executor = None
+
+
+def docker_client():
+    global _docker_client
+    with _docker_client_lock:
+        if _docker_client is None:
+            _docker_client = docker.from_env(timeout=_docker_timeout, max_pool_size=_docker_max_pool_size)
+        return _docker_client
+
+
+def streaming_docker_client():
+    # followed log streams can stay silent for longer than DOCKER_TIMEOUT, so they go through a client without timeout
+    global _streaming_docker_client
+    with _docker_client_lock:
+        if _streaming_docker_client is None:
+            _streaming_docker_client = docker.from_env(timeout=None, max_pool_size=_docker_max_pool_size)
+        return _streaming_docker_client
+
+
+_image_cache = ImageCache(docker_client, pull_workers=int(os.environ.get('IMAGE_PULL_WORKERS', 2)),
+                          max_bytes=_image_cache_max_bytes)
 
 
 class DockerWorker:
@@ -28,8 +85,10 @@ class DockerWorker:
         self._APSSchedulerJob = APSSchedulerJob
         self._job = None
         self._container = None
-        self._client = docker.from_env()
+        self._client = docker_client()
         self._lock = RLock()
+        self._state = "idle"
+        self._assigned_gpu_ids = None
 
     @property
     def status(self):
@@ -53,83 +112,195 @@ class DockerWorker:
     def worker_id(self):
         return self._worker_id
 
+    @property
+    def idle(self):
+        return self._state == "idle" and self._job is None
+
+    def assign(self, job, gpu_ids=None):
+        # returns False if the worker was deleted or given a job since it was found idle
+        from datetime import datetime
+        from tzlocal import get_localzone
+        from flask_apscheduler.scheduler import JobLookupError
+
+        with _dispatch_condition:
+            if not self.idle or self not in _workers.values():
+                return False
+            self._job = job
+            self._assigned_gpu_ids = gpu_ids
+            self._state = "assigned"
+
+        try:
+            self._APSSchedulerJob.modify(next_run_time=datetime.now(get_localzone()))
+        except JobLookupError:
+            # deleted meanwhile; stopping the worker already took care of the job
+            pass
+        return True
+
+    def run_assigned_job(self):
+        with _dispatch_condition:
+            if self._state != "assigned":
+                return
+            job, gpu_ids = self._job, self._assigned_gpu_ids
+            self._assigned_gpu_ids = None
+
+            if job is None:
+                # the job was stopped before the worker got to it
+                self._state = "idle"
+                self._unlock_gpus(gpu_ids)
+                return
+            self._state = "busy"
+
+        try:
+            self.run_job(job, gpu_ids)
+        finally:
+            with _dispatch_condition:
+                self._state = "idle"
+            notify_queue_changed()
+
     def run_job(self, job, gpu_ids=None, remove_working_dir=True):
+        # returns True when the container was handed over to the container watcher, which then owns the GPUs
         import subprocess
         self._job = job
 
         job = self.job
         job_id = job['job_id']
 
-        running_jobs[job_id] = job
+        # kept with the running job so that a restarted scheduler can find its container and GPUs again
+        job['gpu_ids'] = list(gpu_ids or [])
+        job['scheduler_url'] = my_url
 
-        routing_map['job_id'][job_id] = my_url
+        container = None
+        handed_over = False
+        try:
+            running_jobs[job_id] = job
+            index_job(job_id, 'running', worker_id=self._worker_id)
 
-        _extract_job_bundle_to_working_dir_if_not_exist(job_id)
+            routing_map['job_id'][job_id] = my_url
 
-        job['spec']['detach'] = True
+            try:
+                # anything failing before the container runs fails the job, and the finally below frees the worker
+                _extract_job_bundle_to_working_dir_if_not_exist(job_id)
 
-        lc = LogConfig(type=LogConfig.types.JSON, config={'max-size': '1g', 'labels': 'atlas_logging'})
-        job['spec']['log_config'] = lc
+                job['spec']['detach'] = True
 
-        if len(job['spec']['image'].split(':')) < 2:
-            job['spec']['image'] = job['spec']['image']+':latest'
+                lc = LogConfig(type=LogConfig.types.JSON, config={'max-size': '1g', 'labels': 'atlas_logging'})
+                job['spec']['log_config'] = lc
 
-        if gpu_ids:
-            if len(gpu_ids) > 0:
-                job['spec']['environment']["NVIDIA_VISIBLE_DEVICES"] = ",".join(gpu_ids)
+                labels = job['spec'].get('labels') or {}
+                if isinstance(labels, list):
+                    labels = dict.fromkeys(labels, '')
+                job['spec']['labels'] = {**labels, _JOB_ID_LABEL: job_id, _WORKER_ID_LABEL: str(self._worker_id)}
 
-        container = None
-        try:
-            job['start_time'] = time()
-            self._container = self._client.containers.run(**job['spec'])
-            container = self._container
-            logging.info(f"[Worker {self._worker_id}] - Job {job_id} started")
+                job['spec']['image'] = normalize_image(job['spec']['image'])
+                _image_cache.wait_for(job['spec']['image'])
 
-        except Exception as e:
-            logging.info(f"[Worker {self._worker_id}] - Job {job_id} failed to start " + str(e))
-            job['logs'] = str(e)
-            self.stop_job(timeout=0)
-            return
+                if gpu_ids:
+                    if len(gpu_ids) > 0:
+                        job['spec']['environment']["NVIDIA_VISIBLE_DEVICES"] = ",".join(gpu_ids)
 
-        tracker_clients.running(job)
+                _apply_resource_limits(job)
+                job['start_time'] = time()
+                self._container = self._client.containers.run(**job['spec'])
+                container = self._container
+                logging.info(f"[Worker {self._worker_id}] - Job {job_id} started")
+
+            except Exception as e:
+                logging.info(f"[Worker {self._worker_id}] - Job {job_id} failed to start " + str(e))
+                job['logs'] = str(e)
+                self.stop_job(timeout=0)
+                return False
+
+            tracker_clients.running(job)
+
+            if _container_wait_mode == 'events':
+                _watch_container(container, self, gpu_ids, remove_working_dir)
+                handed_over = True
+                return True
 
-        try:
-            return_code = container.wait()
-            job['logs'] = container.logs()
             try:
-                job['logs'] = job['logs'].decode()
-            except (UnicodeDecodeError, AttributeError):
-                pass
-        except Exception as e:
-            job['end_time'] = time()
-            logging.info(f"[Worker {self._worker_id}] - Worker {self._worker_id} failed to reconnect to job {job_id}, killing job now")
+                return_code = container.wait()
+                logs = log_store.save(job_id, container.logs(stream=True))
+            except Exception as e:
+                job['end_time'] = time()
+                logging.info(f"[Worker {self._worker_id}] - Worker {self._worker_id} failed to reconnect to job {job_id}, killing job now")
 
-            self.stop_job(timeout=0)
+                self.stop_job(timeout=0)
+            else:
+                self.finish_job(job, container, return_code, remove_working_dir, logs)
+            return False
+        finally:
+            if not handed_over:
+                self._delete_running_job(job_id)
+                if gpu_ids:
+                    self._unlock_gpus(gpu_ids)
+                notify_queue_changed()
+
+    def finish_job(self, job, container, return_code, remove_working_dir=True, logs=None):
+        # the job is passed in since stop_job may clear it from the worker at any time
+        job_id = job['job_id']
+
+        job.update(logs or log_store.save(job_id, container.logs(stream=True)))
+        job['end_time'] = time()
+        job['return_code'] = return_code
+        logging.info(f"[Worker {self._worker_id}] - Job {job_id} finished with return code {return_code}")
+
+        if not return_code['StatusCode']:
+            completed_jobs[job_id] = job
+            index_job(job_id, 'completed')
+            tracker_clients.completed(job)
         else:
-            job['end_time'] = time()
-            job['return_code'] = return_code
-            logging.info(f"[Worker {self._worker_id}] - Job {job_id} finished with return code {return_code}")
+            failed_jobs[job_id] = job
+            index_job(job_id, 'failed')
+            tracker_clients.failed(job)
 
-            if not return_code['StatusCode']:
-                completed_jobs[job_id] = job
-                tracker_clients.completed(job)
-            else:
-                failed_jobs[job_id] = job
-                tracker_clients.failed(job)
+        self._cleanup_job(container, job_id, remove_working_dir)
 
-            self._cleanup_job(container, job_id, remove_working_dir)
+    def resume_job(self, job, container, gpu_ids):
+        # takes over a container started before the scheduler restarted
+        with self._lock:
+            self._job = job
+            self._container = container
+        running_jobs[job['job_id']] = job
+        index_job(job['job_id'], 'running', worker_id=self._worker_id)
+        self._lock_gpu_ids(gpu_ids)
+        try:
+            resource_pool.reserve(job['job_id'], *_resources_required(job)[1:])
+        except ValueError as error:
+            logging.warning(f"[Worker {self._worker_id}] - could not account the resources of job {job['job_id']}: {error}")
 
+        if _container_wait_mode == 'events':
+            _watch_container(container, self, gpu_ids, True)
+        else:
+            Thread(target=self._wait_for_resumed_job, args=[job, container, gpu_ids], daemon=True).start()
+
+    def _wait_for_resumed_job(self, job, container, gpu_ids):
+        try:
+            return_code = container.wait()
+            logs = log_store.save(job['job_id'], container.logs(stream=True))
+        except Exception as e:
+            logging.info(f"[Worker {self._worker_id}] - failed to reconnect to job {job['job_id']}, killing job now")
+            self.stop_job(timeout=0)
+        else:
+            self.finish_job(job, container, return_code, True, logs)
         finally:
-            self._delete_running_job(job_id)
-            if gpu_ids:
-                self._unlock_gpus(gpu_ids)
+            self.release_job(job, gpu_ids)
+
+    def release_job(self, job, gpu_ids):
+        self._delete_running_job(job['job_id'])
+        self._unlock_gpus(gpu_ids)
+        notify_queue_changed()
 
     def _delete_running_job(self, job_id):
         with self._lock:
-            self._job = None
-            self._container = None
-            if job_id in running_jobs:
+            # the worker may already run another job if this one was stopped in the meantime
+            if self._job is not None and self._job['job_id'] == job_id:
+                self._job = None
+                self._container = None
+            resource_pool.release(job_id)
+            try:
                 del running_jobs[job_id]
+            except KeyError:
+                pass
 
     def stop_job(self, reschedule=False, timeout=5):
         if self.job is None:
@@ -141,9 +312,12 @@ class DockerWorker:
             if reschedule:
                 try:
                     queue.insert(0, job['job_spec'])
+                    notify_queue_changed()
                 except (KeyError, TypeError):
                     pass
 
+            watch = _unwatch_container(self._container.id) if self._container else None
+
             if self._container:
                 try:
                     self._container.stop(timeout=timeout)
@@ -151,8 +325,20 @@ class DockerWorker:
                     logging.error("Couldn't stop the container:")
                     logging.error(e)
 
+            if watch is not None:
+                # nothing is waiting on the container in the worker thread, so it is cleaned up and its GPUs are
+                # released here
+                try:
+                    job.update(log_store.save(job_id, self._container.logs(stream=True)))
+                except Exception as e:
+                    logging.error(f"Could not save the logs of job {job_id}: {e}")
+                self._cleanup_job(self._container, job_id, watch[2])
+                self._unlock_gpus(watch[1])
+                notify_queue_changed()
+
             try:
                 failed_jobs[job_id] = job
+                index_job(job_id, 'failed')
                 tracker_clients.failed(job)
             except TypeError:
                 pass
@@ -176,6 +362,19 @@ class DockerWorker:
         else:
             return None
 
+    def stream_logs(self, since=None, follow=False, tail='all', timestamps=False):
+        container = self._container
+        if container is None:
+            return None
+
+        # docker only filters by whole seconds, so lines of the second since falls in are sent again
+        since = int(since) if since and since >= 1 else None
+
+        if follow:
+            return streaming_docker_client().api.logs(container.id, stream=True, follow=True, since=since, tail=tail,
+                                                      timestamps=timestamps)
+        return container.logs(stream=True, follow=False, since=since, tail=tail, timestamps=timestamps)
+
     def container_id(self):
         if self._container is not None:
             return self._container.id
@@ -197,69 +396,54 @@ class DockerWorker:
             locked_gpus.append(available_ids[i])
         return locked_gpus
 
+    @staticmethod
+    def _lock_gpu_ids(gpu_ids):
+        for gpu_id in gpu_ids or []:
+            gpu_pool[gpu_id] = "locked"
+
     def _unlock_gpus(self, ids_to_unlock):
         if ids_to_unlock:
             for gpu_id in ids_to_unlock:
                 gpu_pool[gpu_id] = "unlocked"
 
-    def _remove_job_from_queue_and_fail(self, error_message):
-        self._job = self._poll_queue()
-        self.job['logs'] = str(error_message)
-        self.stop_job(timeout=0)
-
     def peek_queue(self):
         logging.debug(f"[Worker {self._worker_id}] - peeking")
 
+        if self._job is not None:
+            # the previous job is still running under the container watcher
+            return
+
         job = None
         gpu_ids_for_job = None
+        handed_over = False
         peek_lock.acquire()
         try:
-            peek_job = queue.peek()
-            num_gpus = peek_job.get("gpu_spec", {}).get("num_gpus", 0)
+            available_gpu_ids = self._get_available_gpus()
+            job = _pop_next_job(len(available_gpu_ids))
+            if job is None:
+                raise ResourceWarning(f"[Worker {self._worker_id}] - not enough resources available for job, waiting for free resources")
 
             try:
-                num_gpus = int(num_gpus)
-            except ValueError:
-                error_message = f"Foundations ERROR: Job '{peek_job['job_id']}' was given a value that could not be converted to an integer for GPUs usage ({num_gpus})"
-                self._remove_job_from_queue_and_fail(error_message)
-                raise ResourceWarning(error_message)
-
-            if num_gpus > len(gpu_pool):
-                error_message = f"Foundations ERROR: Job '{peek_job['job_id']}' expects to use more GPUs ({num_gpus}) than available ({len(gpu_pool)}), removing from the queue"
-                self._remove_job_from_queue_and_fail(error_message)
-                raise ResourceWarning(error_message)
-            elif num_gpus >= 0:
-                available_gpu_ids = self._get_available_gpus()
-                if not self._gpu_availability_is_sufficient(num_gpus, len(available_gpu_ids)):
-                    raise ResourceWarning(f"[Worker {self._worker_id}] - not enough GPUs available for job, waiting for free resources")
-                gpu_ids_for_job = self._lock_gpus(num_gpus, available_gpu_ids)
-            else:
-                error_message = f"Foundations ERROR: Job '{peek_job['job_id']}' expects an invalid number of GPUs ({num_gpus})"
-                self._remove_job_from_queue_and_fail(error_message)
-                raise ResourceWarning(error_message)
+                num_gpus, cpus, memory = _resources_required(job)
+            except ValueError as error:
+                _fail_queued_job(job, error)
+                job = None
+                raise ResourceWarning(str(error))
+
+            gpu_ids_for_job = self._lock_gpus(num_gpus, available_gpu_ids)
+            resource_pool.reserve(job['job_id'], cpus, memory)
         except IndexError:
             logging.info(f"[Worker {self._worker_id}] - no jobs in queue, no jobs started")
         except ResourceWarning as error:
             logging.info(error)
-        else:
-            job = self._poll_queue()
         finally:
             peek_lock.release()
             try:
                 if job:
-                    self.run_job(job, gpu_ids_for_job)
+                    handed_over = self.run_job(job, gpu_ids_for_job)
             finally:
-                self._unlock_gpus(gpu_ids_for_job)
-
-    def _poll_queue(self):
-        logging.debug(f"[Worker {self._worker_id}] - polling")
-
-        try:
-            job = copy.deepcopy(queue.pop(0))
-            return job
-        except IndexError:
-            logging.info(f"[Worker {self._worker_id}] - no jobs in queue, no jobs started") # change message
-            return None
+                if not handed_over:
+                    self._unlock_gpus(gpu_ids_for_job)
 
     @staticmethod
     def remove_working_directory(job_id):
@@ -290,11 +474,21 @@ def add():
         worker_id = sorted(_workers)[-1] + 1
     except IndexError:
         worker_id = 0
-    job = get_app().apscheduler.add_job(func=worker_job,
-                                  trigger='interval',
-                                  seconds=_interval,
-                                  args=[worker_id],
-                                  id=str(worker_id))
+    if _dispatch_mode == 'event':
+        # workers are woken up by the dispatcher when a job is assigned to them
+        # a second instance is allowed so that an assignment arriving while the previous run is returning is not skipped
+        job = get_app().apscheduler.add_job(func=worker_job,
+                                      trigger='interval',
+                                      seconds=_idle_interval,
+                                      args=[worker_id],
+                                      id=str(worker_id),
+                                      max_instances=2)
+    else:
+        job = get_app().apscheduler.add_job(func=worker_job,
+                                      trigger='interval',
+                                      seconds=_interval,
+                                      args=[worker_id],
+                                      id=str(worker_id))
     _workers[worker_id] = DockerWorker(worker_id, job)
     return str(worker_id)
 
@@ -328,8 +522,10 @@ def get_cron_workers():
 
 
 def delete_worker(worker_id, reschedule=False):
-    _workers[worker_id].delete(reschedule)
-    del _workers[worker_id]
+    # removing the worker under the dispatch lock guarantees the dispatcher never assigns to a deleted worker
+    with _dispatch_condition:
+        worker = _workers.pop(worker_id)
+    worker.delete(reschedule)
 
 def delete_cron_worker(worker_id):
     from flask_apscheduler.scheduler import JobLookupError
@@ -357,6 +553,12 @@ def worker_by_job_id(job_id):
         return None
 
 
+def worker_by_id(worker_id):
+    if str(worker_id).startswith('cron_'):
+        return _cron_workers.get(get_cron_worker_index(worker_id))
+    return _workers.get(worker_id)
+
+
 def cron_worker_by_job_id(job_id):
     for worker_id, worker in _cron_workers.items():
         if worker.apscheduler_job.name == job_id:
@@ -387,6 +589,7 @@ def delete_archive(job_id):
         logging.error("A valid job UUID was not provided")
         raise IndexError
 
+    remove_cached_archives(job_id)
     try:
         rmtree('/archives/archive/'+job_id)
         logging.info(f"Successfully deleted archive for Job {job_id}")
@@ -396,8 +599,207 @@ def delete_archive(job_id):
         raise IndexError
 
 
+def notify_queue_changed():
+    global _queue_generation
+
+    if _dispatch_mode != 'event':
+        return
+
+    with _dispatch_condition:
+        _queue_generation += 1
+        _dispatch_condition.notify()
+
+
+def start_dispatcher():
+    global _queue_subscription, _dispatcher_thread
+
+    if _dispatch_mode != 'event' or _dispatcher_thread is not None:
+        return
+
+    _dispatcher_thread = Thread(target=_dispatch_loop, name='dispatcher', daemon=True)
+    _dispatcher_thread.start()
+
+    # backends shared between several schedulers publish their changes so that every node wakes up
+    if hasattr(queue, 'subscribe'):
+        _queue_subscription = queue.subscribe(notify_queue_changed)
+
+
+def _dispatch_loop():
+    generation = None
+    while True:
+        with _dispatch_condition:
+            if generation == _queue_generation:
+                # the timeout is only a safety net in case a notification is missed
+                _dispatch_condition.wait(timeout=_idle_interval)
+            generation = _queue_generation
+
+        try:
+            _dispatch()
+        except Exception:
+            logging.exception("[Dispatcher] - failed to dispatch jobs")
+
+
+def _dispatch():
+    # the dispatch lock is only held to read and change the state of the workers, not across the queue I/O
+    with peek_lock:
+        with _dispatch_condition:
+            idle_workers = [worker for worker in _workers.values() if worker.idle]
+
+        while idle_workers:
+            worker = idle_workers.pop(0)
+            available_gpu_ids = worker._get_available_gpus()
+
+            try:
+                job = _pop_next_job(len(available_gpu_ids))
+            except IndexError:
+                logging.debug("[Dispatcher] - no jobs in queue")
+                return
+
+            if job is None:
+                logging.info("[Dispatcher] - not enough resources available for job, waiting for free resources")
+                return
+
+            try:
+                num_gpus, cpus, memory = _resources_required(job)
+            except ValueError as error:
+                logging.info(error)
+                _fail_queued_job(job, error)
+                idle_workers.insert(0, worker)
+                continue
+
+            gpu_ids = worker._lock_gpus(num_gpus, available_gpu_ids)
+            resource_pool.reserve(job['job_id'], cpus, memory)
+            if not worker.assign(job, gpu_ids):
+                worker._unlock_gpus(gpu_ids)
+                resource_pool.release(job['job_id'])
+                queue.insert(0, job)
+                continue
+            logging.info(f"[Dispatcher] - Job {job['job_id']} assigned to worker {worker.worker_id}")
+
+
+def _pop_next_job(num_available_gpus):
+    # pops the first job of the admission window that fits in the available GPUs, CPUs and memory, preferring the head
+    # and otherwise the job that fills the free resources best; jobs with invalid requirements are always popped so
+    # that they can be failed. Raises IndexError if the queue is empty, returns None if no job fits
+    if hasattr(queue, 'pop_first_fit'):
+        return _pop_first_fit(num_available_gpus)
+
+    for _ in range(3):
+        candidates = _queue_window(_admission_window)
+        if not candidates:
+            raise IndexError
+
+        chosen = _choose_job(candidates, num_available_gpus)
+        if chosen is None:
+            return None
+
+        job = _pop_queued_job(*chosen)
+        if job is not None:
+            return copy.deepcopy(job)
+    # the queue keeps changing under us; try again on the next dispatch
+    return None
+
+
+def _pop_first_fit(num_available_gpus):
+    # the queue makes the same choice as _choose_job in one atomic step, so that schedulers sharing it cannot start
+    # the same job twice
+    head_id, skips = _skipped_head
+    capacity = (len(gpu_pool), resource_pool.cpus or None, resource_pool.memory or None)
+    job, skipped_head = queue.pop_first_fit(_admission_window, (num_available_gpus, *resource_pool.free()), capacity,
+                                            blocked_head=head_id if skips >= _admission_max_skips else None)
+    if skipped_head is not None:
+        _skipped_head[:] = [skipped_head, skips + 1 if skipped_head == head_id else 1]
+    return job
+
+
+def _queue_window(size):
+    if hasattr(queue, 'window'):
+        return queue.window(size)
+    return list(enumerate(queue[:size]))
+
+
+def _pop_queued_job(key, job):
+    if hasattr(queue, 'pop_item'):
+        return queue.pop_item(key)
+    try:
+        popped = queue.pop(key)
+    except IndexError:
+        return None
+    if popped['job_id'] != job['job_id']:
+        # the queue was changed since it was read
+        queue.insert(key, popped)
+        return None
+    return popped
+
+
+def _choose_job(candidates, num_available_gpus):
+    free_cpus, free_memory = resource_pool.free()
+    best, best_score = None, None
+
+    for position, (key, job) in enumerate(candidates):
+        try:
+            num_gpus, cpus, memory = _resources_required(job)
+        except ValueError:
+            return key, job
+
+        if num_gpus > num_available_gpus or not resource_pool.fits(cpus, memory):
+            continue
+        if position == 0:
+            _skipped_head[:] = [None, 0]
+            return key, job
+
+        # share of the free resources the job would take; the fullest fit wins and ties go to the earlier job
+        score = sum(required / free for required, free in
+                    [(num_gpus, num_available_gpus), (cpus, free_cpus), (memory, free_memory)] if required)
+        if best_score is None or score > best_score:
+            best, best_score = (key, job), score
+
+    if best is None:
+        return None
+
+    head_id = candidates[0][1]['job_id']
+    skips = _skipped_head[1] if _skipped_head[0] == head_id else 0
+    if skips >= _admission_max_skips:
+        # nothing else starts until the head fits, so that it is not starved by smaller jobs
+        return None
+    _skipped_head[:] = [head_id, skips + 1]
+    return best
+
+
+def _resources_required(job):
+    num_gpus, cpus, memory = job_requirements(job)
+
+    if num_gpus > len(gpu_pool):
+        raise ValueError(f"Foundations ERROR: Job '{job['job_id']}' expects to use more GPUs ({num_gpus}) than available ({len(gpu_pool)}), removing from the queue")
+    elif resource_pool.exceeds_capacity(cpus, memory):
+        raise ValueError(f"Foundations ERROR: Job '{job['job_id']}' expects to use more CPUs or memory ({cpus} CPUs, {memory} bytes) than available ({resource_pool.cpus} CPUs, {resource_pool.memory} bytes), removing from the queue")
+
+    return num_gpus, cpus, memory
+
+
+def _apply_resource_limits(job):
+    # the declared requests become the limits of the container, so that a job cannot use more than it was admitted with
+    resource_spec = job.get('resource_spec') or {}
+    if resource_spec.get('cpus'):
+        job['spec']['nano_cpus'] = int(float(resource_spec['cpus']) * 1e9)
+    if resource_spec.get('memory'):
+        job['spec']['mem_limit'] = parse_memory(resource_spec['memory'])
+
+
+def _fail_queued_job(job, error_message):
+    job['logs'] = str(error_message)
+    failed_jobs[job['job_id']] = job
+    index_job(job['job_id'], 'failed')
+    tracker_clients.failed(job)
+
+
 def worker_job(worker_id):
-    _workers[worker_id].peek_queue()
+    worker = _workers[worker_id]
+
+    if _dispatch_mode == 'event':
+        worker.run_assigned_job()
+    else:
+        worker.peek_queue()
 
 def cron_worker_job(cron_worker_index, scheduled_job):
     import copy
@@ -406,6 +808,10 @@ def cron_worker_job(cron_worker_index, scheduled_job):
     now = datetime.now()
     timestamp = now.strftime('%Y%m%d_%H%M%S')
 
+    if _cron_workers[cron_worker_index].job is not None:
+        logging.info(f"Skipping run of scheduled job {scheduled_job['job_id']}: the previous run is still going")
+        return
+
     old_job_id = scheduled_job['job_id']
     new_job_id = f'{old_job_id}_{timestamp}'
 
@@ -451,6 +857,177 @@ def _rewrite_volumes(spec_volumes, new_job_id):
     return new_volumes
 
 def _extract_job_bundle_to_working_dir_if_not_exist(job_id):
-    if not os.path.isdir(path.join(_WORKING_DIR, f"{job_id}")):
-        with tarfile.open(path.join(_JOB_BUNDLE_STORE_DIR, f"{job_id}.tgz")) as tar:
-            tar.extractall(path=_WORKING_DIR)
\ No newline at end of file
+    job_bundle_store.extract(job_id)
+
+
+def start_container_watcher():
+    global _watcher_thread, _finishing_executor
+    from concurrent.futures import ThreadPoolExecutor
+
+    if _container_wait_mode != 'events' or _watcher_thread is not None:
+        return
+
+    # saving the logs of a finished job can take a while, so it does not happen on the event stream thread
+    _finishing_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('CONTAINER_FINISHING_THREADS', 4)))
+    _watcher_thread = Thread(target=_watch_events, name='container-watcher', daemon=True)
+    _watcher_thread.start()
+
+
+def _watch_container(container, worker, gpu_ids, remove_working_dir):
+    with _watch_lock:
+        _watched_containers[container.id] = (worker, gpu_ids, remove_working_dir)
+
+    # the container may have exited before it was registered, in which case its event was already missed
+    _check_container(container.id)
+
+
+def _unwatch_container(container_id):
+    with _watch_lock:
+        return _watched_containers.pop(container_id, None)
+
+
+def _check_container(container_id):
+    try:
+        container = docker_client().containers.get(container_id)
+    except Exception as error:
+        logging.warning(f"Could not inspect container {container_id}: {error}")
+        return
+
+    if container.status in ('exited', 'dead'):
+        state = container.attrs['State']
+        _container_exited(container_id, state.get('ExitCode', -1), state.get('OOMKilled', False))
+
+
+def _watch_events():
+    from datetime import datetime
+
+    since = None
+    while True:
+        try:
+            events = docker_client().events(decode=True, since=since,
+                                             filters={'type': 'container', 'event': ['die', 'oom'],
+                                                      'label': [_JOB_ID_LABEL]})
+            if since is not None:
+                # events may have been missed while the stream was down
+                with _watch_lock:
+                    container_ids = list(_watched_containers)
+                for container_id in container_ids:
+                    _check_container(container_id)
+
+            for event in events:
+                since = datetime.utcfromtimestamp(event['time'])
+                attributes = event.get('Actor', {}).get('Attributes', {})
+                if event.get('status') == 'oom':
+                    _mark_oom_killed(event['id'])
+                elif event.get('status') == 'die':
+                    _container_exited(event['id'], int(attributes.get('exitCode', -1)))
+        except Exception as error:
+            logging.error(f"Docker event stream failed, reconnecting: {error}")
+            since = since or datetime.utcnow()
+            sleep(1)
+
+
+def _mark_oom_killed(container_id):
+    with _watch_lock:
+        watch = _watched_containers.get(container_id)
+    if watch is not None and watch[0].job is not None:
+        watch[0].job['oom_killed'] = True
+
+
+def _container_exited(container_id, exit_code, oom_killed=False):
+    watch = _unwatch_container(container_id)
+    if watch is None:
+        # already finished, or stopped through the API
+        return
+
+    worker, job = watch[0], watch[0].job
+    if job is None:
+        worker._unlock_gpus(watch[1])
+        notify_queue_changed()
+        return
+    if oom_killed:
+        job['oom_killed'] = True
+    _finishing_executor.submit(_finish_watched_job, container_id, exit_code, job, *watch)
+
+
+def _finish_watched_job(container_id, exit_code, job, worker, gpu_ids, remove_working_dir):
+    container = None
+    try:
+        container = docker_client().containers.get(container_id)
+        worker.finish_job(job, container, {'Error': None, 'StatusCode': exit_code}, remove_working_dir)
+    except Exception as error:
+        logging.error(f"Could not finish job of container {container_id}: {error}")
+        job['end_time'] = time()
+        failed_jobs[job['job_id']] = job
+        index_job(job['job_id'], 'failed')
+        tracker_clients.failed(job)
+
+        # best effort, so that the container and the working directory are not left behind
+        try:
+            if container is None:
+                container = docker_client().containers.get(container_id)
+            DockerWorker._cleanup_job(container, job['job_id'], remove_working_dir)
+        except Exception as cleanup_error:
+            logging.error(f"Could not clean up job of container {container_id}: {cleanup_error}")
+            if remove_working_dir:
+                DockerWorker.remove_working_directory(job['job_id'])
+    finally:
+        worker.release_job(job, gpu_ids)
+
+
+def recover_running_jobs():
+    # reattaches the containers of jobs that were running when the scheduler stopped; one Docker call and one pass over
+    # running_jobs, so it runs on every start
+    try:
+        containers = docker_client().containers.list(all=True, filters={'label': _JOB_ID_LABEL})
+    except Exception as error:
+        logging.error(f"Could not list job containers to recover running jobs: {error}")
+        return
+
+    jobs = {job_id: job for job_id, job in iter_items(running_jobs) if job.get('scheduler_url') == my_url}
+    recovered = 0
+
+    for container in containers:
+        job = jobs.pop(container.labels.get(_JOB_ID_LABEL), None)
+        if job is None:
+            continue
+
+        worker = next((worker for worker in _workers.values() if worker.idle), None)
+        if worker is None:
+            worker = _workers[int(add())]
+        worker.resume_job(job, container, job.get('gpu_ids'))
+        recovered += 1
+
+    # jobs of this node whose container is gone cannot be recovered
+    for job_id, job in jobs.items():
+        logging.warning(f"Container of running job {job_id} was not found; marking it as failed")
+        job['end_time'] = time()
+        failed_jobs[job_id] = job
+        index_job(job_id, 'failed')
+        tracker_clients.failed(job)
+        try:
+            del running_jobs[job_id]
+        except KeyError:
+            pass
+
+    if recovered or jobs:
+        logging.info(f"Recovered {recovered} running jobs, {len(jobs)} could not be recovered")
+
+
+def prefetch_image(image):
+    if _image_prepull and image:
+        _image_cache.prefetch(image)
+
+
+def start_image_garbage_collector():
+    if not _image_cache_max_bytes:
+        return
+    get_app().apscheduler.add_job(func=collect_image_garbage, trigger='interval', seconds=_image_gc_interval,
+                                  id='image_gc', max_instances=1)
+
+
+def collect_image_garbage():
+    try:
+        _image_cache.collect_garbage()
+    except Exception as error:
+        logging.error(f"Image garbage collection failed: {error}")
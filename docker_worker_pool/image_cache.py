@@ -0,0 +1,100 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+
+
+def normalize_image(image):
+    if len(image.split(':')) < 2:
+        return image + ':latest'
+    return image
+
+
+class ImageCache:
+    # pulls the images of queued jobs ahead of time and removes the least recently used images once the images on the
+    # node take more than max_bytes
+    def __init__(self, client_factory, pull_workers=2, max_bytes=0):
+        self._client = client_factory
+        self._max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=pull_workers)
+        self._lock = Lock()
+        # image -> future of the pull in progress
+        self._pulls = {}
+        # image -> last time a job used or queued it
+        self._last_used = {}
+
+    def prefetch(self, image):
+        image = normalize_image(image)
+        with self._lock:
+            self._last_used[image] = time()
+            if image in self._pulls:
+                return
+            pull = self._pulls[image] = self._executor.submit(self._pull, image)
+        # outside of the lock, since the callback runs right away if the pull is already done
+        pull.add_done_callback(lambda _: self._forget_pull(image))
+
+    def _forget_pull(self, image):
+        with self._lock:
+            self._pulls.pop(image, None)
+
+    def _pull(self, image):
+        from docker.errors import ImageNotFound
+
+        try:
+            self._client().images.get(image)
+            return
+        except ImageNotFound:
+            pass
+
+        logging.info(f"Pulling image {image}")
+        repository, tag = image.rsplit(':', 1)
+        try:
+            self._client().images.pull(repository, tag=tag)
+            logging.info(f"Pulled image {image}")
+        except Exception as error:
+            # the job itself reports the error if the image still cannot be pulled when it starts
+            logging.warning(f"Could not pull image {image}: {error}")
+
+    def wait_for(self, image):
+        # a job starting while its image is being pulled waits for that pull instead of starting a second one
+        image = normalize_image(image)
+        with self._lock:
+            self._last_used[image] = time()
+            pull = self._pulls.get(image)
+        if pull is not None:
+            pull.result()
+
+    def collect_garbage(self):
+        if not self._max_bytes:
+            return
+
+        client = self._client()
+        used_bytes = client.df()['LayersSize']
+        if used_bytes <= self._max_bytes:
+            return
+
+        with self._lock:
+            last_used = dict(self._last_used)
+            pulling = set(self._pulls)
+        in_use = {container.attrs['Image'] for container in client.containers.list(all=True)}
+
+        def last_use(image):
+            times = [last_used.get(tag, 0) for tag in image.tags]
+            return max(times) if times else 0
+
+        for image in sorted(client.images.list(), key=last_use):
+            if used_bytes <= self._max_bytes:
+                break
+            if image.id in in_use or pulling.intersection(image.tags):
+                continue
+            try:
+                client.images.remove(image.id, force=False)
+            except Exception as error:
+                logging.info(f"Could not remove image {image.tags or image.id}: {error}")
+                continue
+            logging.info(f"Removed image {image.tags or image.id} to free disk space")
+            # shared layers make this an overestimate; the next collection starts from the real usage again
+            used_bytes -= image.attrs.get('Size', 0)
+            with self._lock:
+                for tag in image.tags:
+                    self._last_used.pop(tag, None)
@@ -14,14 +14,21 @@ def get_app():
     from apscheduler.jobstores.memory import MemoryJobStore
 
     from tracker_client_plugins import tracker_clients
+    from db import gpu_pool
+    from db.redis_connection import connection_pool
     import docker_worker_pool
     from docker_worker_pool import get_cron_workers, DockerWorker
+    from local_docker_scheduler.constants import _JOB_BUNDLE_MAX_SIZE
 
     global _app
     if _app is not None:
         return _app
 
     _app = Flask(__name__)
+    # multipart uploads are spooled by Werkzeug before the route sees them, so they are limited up front; the margin
+    # leaves room for the multipart headers around a bundle of the maximum size
+    if _JOB_BUNDLE_MAX_SIZE:
+        _app.config['MAX_CONTENT_LENGTH'] = _JOB_BUNDLE_MAX_SIZE + (1 << 20)
 
     # load tracker plugins
     try:
@@ -33,9 +40,13 @@ def get_app():
     except FileNotFoundError:
         pass
 
+    tracker_clients.start()
+    atexit.register(tracker_clients.flush)
+
+    redis_tracker = tracker_dict['redis_tracker_client']
     job_stores = {
-        'redis': RedisJobStore(host=tracker_dict['redis_tracker_client']['host'],
-                               port=tracker_dict['redis_tracker_client']['port']),
+        'redis': RedisJobStore(connection_pool=connection_pool(redis_tracker['host'], redis_tracker['port'],
+                                                               unix_socket=redis_tracker.get('unix_socket'))),
         'default': MemoryJobStore()}
 
     _app.config['SCHEDULER_JOBSTORES'] = job_stores
@@ -47,12 +58,23 @@ def get_app():
     scheduler.init_app(_app)
     atexit.register(lambda: scheduler.shutdown(wait=False))
 
+    # the GPUs have to be known before the running jobs are recovered, which locks their GPUs again
+    if os.environ.get("CUDA_VISIBLE_DEVICES", None):
+        gpu_pool.update({k: "unlocked" for k in os.environ["CUDA_VISIBLE_DEVICES"].split(",")})
+
     num_workers = int(os.environ.get("NUM_WORKERS", 1))
     for i in range(num_workers):
         docker_worker_pool.add()
 
+    docker_worker_pool.start_container_watcher()
+    docker_worker_pool.recover_running_jobs()
+
     scheduler.start()
 
+    docker_worker_pool.start_dispatcher()
+    docker_worker_pool.start_image_garbage_collector()
+    docker_worker_pool.notify_queue_changed()
+
     loaded_scheduled_jobs = scheduler.get_jobs(jobstore='redis')
     _cron_workers = get_cron_workers()
     if loaded_scheduled_jobs:
@@ -0,0 +1,95 @@
+import logging
+import os
+import os.path as path
+import re
+import tarfile
+import tempfile
+from threading import Thread
+
+from local_docker_scheduler.constants import _ARTIFACT_CACHE_DIR
+
+
+_CHUNK_SIZE = 64 * 1024
+_MODES = {'tgz': 'w|gz', 'tar': 'w|'}
+# <job_id>-<mtime of the artifacts>.<format>
+_CACHED_ARCHIVE = re.compile(r'(?P<job_id>.+)-\d+\.\d+\.(?P<format>tgz|tar)')
+
+
+def latest_mtime(directory):
+    # directory mtimes only change when entries are added or removed, so files are checked as well
+    latest = path.getmtime(directory)
+    for root, directories, files in os.walk(directory):
+        for name in directories + files:
+            try:
+                latest = max(latest, os.lstat(path.join(root, name)).st_mtime)
+            except FileNotFoundError:
+                pass
+    return latest
+
+
+def cached_archive(job_id, directory, archive_format):
+    if not _ARTIFACT_CACHE_DIR:
+        return None, None
+    cache_path = path.join(_ARTIFACT_CACHE_DIR, f'{job_id}-{latest_mtime(directory):.6f}.{archive_format}')
+    return cache_path, cache_path if path.isfile(cache_path) else None
+
+
+def stream_archive(directory, arcname, archive_format='tgz', cache_path=None):
+    # tarfile writes into a pipe from a separate thread so that the archive is sent while it is being built
+    read_end, write_end = os.pipe()
+
+    errors = []
+
+    def write_archive():
+        try:
+            with os.fdopen(write_end, 'wb') as pipe:
+                with tarfile.open(fileobj=pipe, mode=_MODES[archive_format]) as tar:
+                    tar.add(directory, arcname=arcname)
+        except BrokenPipeError:
+            # the client went away
+            pass
+        except Exception as error:
+            logging.error(f"Failed to archive {directory}: {error}")
+            errors.append(error)
+
+    writer = Thread(target=write_archive, daemon=True)
+    writer.start()
+
+    cache_file = None
+    if cache_path is not None:
+        os.makedirs(path.dirname(cache_path), exist_ok=True)
+        # each request writes its own file, since several requests may archive the same job at once
+        cache_fd, temporary_path = tempfile.mkstemp(dir=path.dirname(cache_path), suffix='.tmp')
+        cache_file = os.fdopen(cache_fd, 'wb')
+
+    completed = False
+    try:
+        with os.fdopen(read_end, 'rb') as pipe:
+            for chunk in iter(lambda: pipe.read(_CHUNK_SIZE), b''):
+                if cache_file is not None:
+                    cache_file.write(chunk)
+                yield chunk
+        writer.join()
+        completed = not errors
+    finally:
+        if cache_file is not None:
+            cache_file.close()
+            if completed:
+                # archives of an older state of the directory are never served again
+                remove_cached_archives(_CACHED_ARCHIVE.fullmatch(path.basename(cache_path)).group('job_id'),
+                                       archive_format, path.dirname(cache_path))
+                os.replace(temporary_path, cache_path)
+            else:
+                os.remove(temporary_path)
+
+
+def remove_cached_archives(job_id, archive_format=None, cache_dir=_ARTIFACT_CACHE_DIR):
+    if not cache_dir or not path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        match = _CACHED_ARCHIVE.fullmatch(name)
+        if match and match.group('job_id') == job_id and archive_format in (None, match.group('format')):
+            try:
+                os.remove(path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
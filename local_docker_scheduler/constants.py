@@ -3,3 +3,9 @@ import os
 _WORKING_DIR = os.environ.get('WORKING_DIR', '/working_dir')
 _ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '/archives/archive')
 _JOB_BUNDLE_STORE_DIR = os.environ.get('JOB_BUNDLE_STORE_DIR', '/job_bundle_store_dir')
+_JOB_BUNDLE_LINK_MODE = os.environ.get('JOB_BUNDLE_LINK_MODE', 'copy')
+_JOB_BUNDLE_EXTRACT_WORKERS = int(os.environ.get('JOB_BUNDLE_EXTRACT_WORKERS', 2))
+_JOB_BUNDLE_MAX_SIZE = int(os.environ.get('JOB_BUNDLE_MAX_SIZE', 0))  # bytes; 0 means no limit
+_LOG_STORE_DIR = os.environ.get('LOG_STORE_DIR', os.path.join(os.path.dirname(_ARCHIVE_DIR), 'logs'))
+_TRACKER_SPOOL_DIR = os.environ.get('TRACKER_SPOOL_DIR', os.path.join(os.path.dirname(_ARCHIVE_DIR), 'tracker_spool'))
+_ARTIFACT_CACHE_DIR = os.environ.get('ARTIFACT_CACHE_DIR', None)
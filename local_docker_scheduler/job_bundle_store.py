@@ -0,0 +1,364 @@
+import hashlib
+import logging
+import os
+import os.path as path
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, RLock
+from uuid import uuid4
+
+from local_docker_scheduler.constants import _JOB_BUNDLE_STORE_DIR, _WORKING_DIR, _JOB_BUNDLE_LINK_MODE, \
+    _JOB_BUNDLE_MAX_SIZE, _JOB_BUNDLE_EXTRACT_WORKERS
+
+
+_CHUNK_SIZE = 1 << 20
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _zstandard():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+@contextmanager
+def _open_tar(bundle_path):
+    # gzip is decompressed by pigz and zstd by the zstd tool when they are installed, so that decompression runs in
+    # its own process alongside the tar parsing
+    with open(bundle_path, 'rb') as bundle:
+        magic = bundle.read(4)
+
+    if magic.startswith(_GZIP_MAGIC):
+        command = ['pigz', '-dc', bundle_path] if shutil.which('pigz') else None
+    elif magic.startswith(_ZSTD_MAGIC):
+        command = ['zstd', '-dcq', bundle_path] if shutil.which('zstd') else None
+        if command is None:
+            if _zstandard() is None:
+                raise ValueError('zstd bundles need the zstandard package or the zstd tool')
+            with open(bundle_path, 'rb') as bundle:
+                with _zstandard().ZstdDecompressor().stream_reader(bundle) as reader:
+                    with tarfile.open(fileobj=reader, mode='r|') as tar:
+                        yield tar
+            return
+    else:
+        command = None
+
+    if command is None:
+        with tarfile.open(bundle_path) as tar:
+            yield tar
+        return
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+            yield tar
+        # tar stops at the end of archive marker; read the rest so that the tool can exit cleanly
+        while process.stdout.read(_CHUNK_SIZE):
+            pass
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code != 0:
+        raise tarfile.ReadError(f'{command[0]} failed to decompress {bundle_path}')
+
+
+def _safe_members(tar, destination):
+    # skips members that would be written outside of the destination, as well as device files
+    destination = path.realpath(destination)
+
+    def inside(target):
+        return target == destination or target.startswith(destination + os.sep)
+
+    for member in tar:
+        target = path.realpath(path.join(destination, member.name))
+        if path.isabs(member.name) or '..' in member.name.split('/') or not inside(target):
+            logging.warning(f"Skipping bundle member {member.name}: path is outside of the bundle")
+            continue
+        if member.issym() and (path.isabs(member.linkname) or
+                               not inside(path.realpath(path.join(path.dirname(target), member.linkname)))):
+            logging.warning(f"Skipping bundle member {member.name}: link points outside of the bundle")
+            continue
+        if member.islnk() and (path.isabs(member.linkname) or
+                               not inside(path.realpath(path.join(destination, member.linkname)))):
+            logging.warning(f"Skipping bundle member {member.name}: link points outside of the bundle")
+            continue
+        if member.isdev():
+            logging.warning(f"Skipping bundle member {member.name}: device files are not allowed")
+            continue
+        yield member
+
+
+class JobBundleTooLarge(Exception):
+    pass
+
+
+class _BundleValidator:
+    # checks the gzip stream and the first tar header while the bundle is being received, so that a bad upload is
+    # rejected after its first chunks and a complete one does not have to be read again
+    def __init__(self):
+        self._decompressor = None
+        self._compressed = None
+        self._header = b''
+
+    def feed(self, chunk):
+        if self._compressed is None:
+            if chunk[:2] == _GZIP_MAGIC:
+                self._compressed = 'gzip'
+                self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            elif chunk[:4] == _ZSTD_MAGIC:
+                self._compressed = 'zstd'
+                self._decompressor = _zstandard().ZstdDecompressor().decompressobj() if _zstandard() else None
+            else:
+                self._compressed = False
+
+        if self._compressed == 'gzip':
+            self._decompress(chunk)
+        elif self._compressed == 'zstd':
+            # only the first tar header is checked; the zstd frame is verified when the bundle is extracted
+            if self._decompressor is not None and len(self._header) < tarfile.BLOCKSIZE:
+                try:
+                    self._check_header(self._decompressor.decompress(chunk))
+                except _zstandard().ZstdError as error:
+                    raise ValueError(f'Invalid zstd stream: {error}')
+        else:
+            self._check_header(chunk)
+
+    def _decompress(self, data):
+        try:
+            while data:
+                # bounded output so that a highly compressed bundle cannot exhaust memory
+                self._check_header(self._decompressor.decompress(data, _CHUNK_SIZE))
+                data = self._decompressor.unconsumed_tail
+                if self._decompressor.eof and self._decompressor.unused_data.strip(b'\x00'):
+                    # concatenated gzip members; trailing zero padding is ignored
+                    data = self._decompressor.unused_data
+                    self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        except zlib.error as error:
+            raise ValueError(f'Invalid gzip stream: {error}')
+
+    def _check_header(self, data):
+        if len(self._header) >= tarfile.BLOCKSIZE:
+            return
+        self._header += data[:tarfile.BLOCKSIZE - len(self._header)]
+        if len(self._header) == tarfile.BLOCKSIZE:
+            try:
+                tarfile.TarInfo.frombuf(self._header, tarfile.ENCODING, 'surrogateescape')
+            except tarfile.HeaderError as error:
+                raise ValueError(f'Invalid tar header: {error}')
+
+    def finish(self):
+        if self._compressed == 'zstd' and self._decompressor is None:
+            return
+        if len(self._header) < tarfile.BLOCKSIZE:
+            raise ValueError('Bundle is too short to be a tar archive')
+        if self._compressed == 'gzip' and not self._decompressor.eof:
+            raise ValueError('Truncated gzip stream')
+
+
+class JobBundleStore:
+    # bundles are stored once under blobs/<sha256>.tgz and <job_id>.tgz is a symlink to the blob, so identical bundles
+    # are uploaded and extracted once; extracted/<sha256> holds the contents without the top level directory
+    def __init__(self, directory, working_dir, link_mode='copy', extract_workers=2):
+        self._directory = directory
+        self._working_dir = working_dir
+        self._link_mode = link_mode
+        self._blob_dir = path.join(directory, 'blobs')
+        self._extracted_dir = path.join(directory, 'extracted')
+        self._extract_lock = Lock()
+        # keeps a blob from being removed while a job is being linked to it
+        self._link_lock = RLock()
+        # sha256 -> future of an extraction in progress
+        self._extractions = {}
+        self._executor = ThreadPoolExecutor(max_workers=extract_workers)
+
+    def bundle_path(self, job_id):
+        return path.join(self._directory, f'{job_id}.tgz')
+
+    def blob_path(self, sha256):
+        return path.join(self._blob_dir, f'{sha256}.tgz')
+
+    def has_blob(self, sha256):
+        return path.isfile(self.blob_path(sha256))
+
+    def is_valid(self, job_id):
+        bundle_path = self.bundle_path(job_id)
+        try:
+            if path.islink(bundle_path):
+                # content addressed bundles were validated when they were uploaded
+                return path.isfile(bundle_path)
+            return tarfile.is_tarfile(bundle_path)
+        except Exception:
+            return False
+
+    def save(self, job_id, stream, max_size=_JOB_BUNDLE_MAX_SIZE):
+        # streams the upload to a temporary file in one pass, hashing and validating it on the way
+        os.makedirs(self._blob_dir, exist_ok=True)
+        temporary_file, temporary_path = tempfile.mkstemp(dir=self._blob_dir, suffix='.tmp')
+
+        try:
+            digest = hashlib.sha256()
+            validator = _BundleValidator()
+            size = 0
+
+            with os.fdopen(temporary_file, 'wb') as blob:
+                for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b''):
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise JobBundleTooLarge(f'Job bundle exceeds {max_size} bytes')
+                    validator.feed(chunk)
+                    digest.update(chunk)
+                    blob.write(chunk)
+                validator.finish()
+
+            sha256 = digest.hexdigest()
+            with self._link_lock:
+                if not self.has_blob(sha256):
+                    os.replace(temporary_path, self.blob_path(sha256))
+                self.link(sha256, job_id)
+        finally:
+            if path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        return sha256
+
+    def link(self, sha256, job_id):
+        with self._link_lock:
+            if not self.has_blob(sha256):
+                raise KeyError(sha256)
+
+            # replace whatever was there atomically so that a job never sees a missing bundle
+            link_path = self.bundle_path(job_id)
+            temporary_link = f'{link_path}.{uuid4().hex}.tmp'
+            os.symlink(path.relpath(self.blob_path(sha256), self._directory), temporary_link)
+            os.replace(temporary_link, link_path)
+
+    def remove(self, job_id):
+        # removes the bundle of a deleted job, and its blob and extracted contents once no other job links to them
+        with self._link_lock:
+            sha256 = self._sha256_of(job_id)
+            try:
+                os.remove(self.bundle_path(job_id))
+            except FileNotFoundError:
+                pass
+            if sha256 is None or self._is_linked(sha256):
+                return
+
+            with self._extract_lock:
+                if sha256 in self._extractions:
+                    # removed by the next deletion instead of pulling the contents from under the extraction
+                    return
+                shutil.rmtree(path.join(self._extracted_dir, sha256), ignore_errors=True)
+            try:
+                os.remove(self.blob_path(sha256))
+            except FileNotFoundError:
+                pass
+
+    def _is_linked(self, sha256):
+        blob_name = f'{sha256}.tgz'
+        with os.scandir(self._directory) as entries:
+            return any(entry.is_symlink() and path.basename(os.readlink(entry.path)) == blob_name
+                       for entry in entries)
+
+    def _sha256_of(self, job_id):
+        bundle_path = self.bundle_path(job_id)
+        if not path.islink(bundle_path):
+            return None
+        return path.basename(path.realpath(bundle_path))[:-len('.tgz')]
+
+    def _extraction(self, sha256):
+        # returns the extraction in progress for the blob, starting one if needed; None if it is already extracted
+        with self._extract_lock:
+            if path.isdir(path.join(self._extracted_dir, sha256)):
+                return None
+            extraction = self._extractions.get(sha256)
+            if extraction is None:
+                extraction = self._executor.submit(self._extract_blob, sha256)
+                self._extractions[sha256] = extraction
+                extraction.add_done_callback(lambda _: self._extractions.pop(sha256, None))
+            return extraction
+
+    def _extracted(self, sha256):
+        extraction = self._extraction(sha256)
+        if extraction is not None:
+            extraction.result()
+        return path.join(self._extracted_dir, sha256)
+
+    def _extract_blob(self, sha256):
+        os.makedirs(self._extracted_dir, exist_ok=True)
+        temporary_path = tempfile.mkdtemp(dir=self._extracted_dir, suffix='.tmp')
+        try:
+            with _open_tar(self.blob_path(sha256)) as tar:
+                tar.extractall(path=temporary_path, members=_safe_members(tar, temporary_path))
+            os.rename(self._content_root(temporary_path), path.join(self._extracted_dir, sha256))
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+    def prefetch(self, job_id):
+        # extracts the bundle of a queued job in the background so that the job does not wait for it when it starts
+        sha256 = self._sha256_of(job_id)
+        extraction = self._extraction(sha256) if sha256 is not None else None
+        if extraction is not None:
+            extraction.add_done_callback(self._log_prefetch_failure)
+
+    @staticmethod
+    def _log_prefetch_failure(extraction):
+        if extraction.exception() is not None:
+            logging.warning(f"Could not extract job bundle ahead of time: {extraction.exception()}")
+
+    @staticmethod
+    def _content_root(directory):
+        # bundles hold a single directory named after the job that uploaded them
+        entries = os.listdir(directory)
+        if len(entries) == 1 and path.isdir(path.join(directory, entries[0])):
+            return path.join(directory, entries[0])
+        return directory
+
+    def _copy_file(self, source, destination):
+        if self._link_mode == 'hardlink':
+            try:
+                return os.link(source, destination)
+            except OSError:
+                pass
+        return shutil.copy2(source, destination)
+
+    def extract(self, job_id):
+        job_working_dir = path.join(self._working_dir, job_id)
+        if path.isdir(job_working_dir):
+            return
+
+        # the working directory is built next to its final location and renamed, so it never appears half written
+        os.makedirs(self._working_dir, exist_ok=True)
+        temporary_path = tempfile.mkdtemp(dir=self._working_dir, prefix=f'.{job_id}.', suffix='.tmp')
+        try:
+            sha256 = self._sha256_of(job_id)
+            if sha256 is None:
+                # bundles uploaded before content addressing are plain files
+                with _open_tar(self.bundle_path(job_id)) as tar:
+                    tar.extractall(path=temporary_path, members=_safe_members(tar, temporary_path))
+                self._move_into_place(self._content_root(temporary_path), job_working_dir)
+            else:
+                content_path = path.join(temporary_path, job_id)
+                shutil.copytree(self._extracted(sha256), content_path, symlinks=True, copy_function=self._copy_file)
+                self._move_into_place(content_path, job_working_dir)
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+    @staticmethod
+    def _move_into_place(source, destination):
+        try:
+            os.rename(source, destination)
+        except OSError:
+            # extracted concurrently for the same job
+            if not path.isdir(destination):
+                raise
+
+
+job_bundle_store = JobBundleStore(_JOB_BUNDLE_STORE_DIR, _WORKING_DIR, _JOB_BUNDLE_LINK_MODE, _JOB_BUNDLE_EXTRACT_WORKERS)
@@ -1,11 +1,11 @@
 from local_docker_scheduler import get_app
-from db import queue, running_jobs, completed_jobs, failed_jobs
-from flask import jsonify, request, make_response
+from db import queue, running_jobs, completed_jobs, failed_jobs, job_index, index_job, index_queued_jobs, unindex_job, log_store, \
+    get_or_none, iter_items, gpu_pool, resource_pool
+from db.job_query import filter_jobs
+from flask import jsonify, request, make_response, json, Response, stream_with_context
 import os
 import os.path as path
 import shutil
-import tarfile
-import tempfile
 from time import time
 from uuid import uuid4
 from werkzeug.utils import secure_filename
@@ -13,11 +13,15 @@ import docker_worker_pool
 import logging
 from tracker_client_plugins import tracker_clients
 from .scheduled_jobs_routes import *
-from .constants import _JOB_BUNDLE_STORE_DIR, _ARCHIVE_DIR
+from .constants import _ARCHIVE_DIR, _JOB_BUNDLE_MAX_SIZE
+from .job_bundle_store import job_bundle_store, JobBundleTooLarge
+from .artifact_archive import cached_archive, stream_archive
 from reverse_proxy import forward
 
 app = get_app()
 
+_QUEUE_PAGE_SIZE = 500
+
 @app.route('/')
 def show_home_page():
     return "Welcome to docker scheduler"
@@ -31,32 +35,72 @@ def save_job_bundle():
         return "Job bundle not found in request", 400
 
     bundle_file = request.files['job_bundle']
-    tarball = path.join(_JOB_BUNDLE_STORE_DIR, secure_filename(bundle_file.filename))
-    bundle_file.save(tarball)
+    job_id = secure_filename(bundle_file.filename)
+    if job_id.endswith('.tgz'):
+        job_id = job_id[:-len('.tgz')]
 
-    if tarfile.is_tarfile(tarball):
-        return 'Job bundle uploaded', 200
-    else:
+    return _save_job_bundle(job_id, bundle_file.stream)
+
+# the request body is the bundle itself, streamed to disk without going through multipart parsing
+@app.route('/job_bundle/<string:job_id>', methods=['PUT'])
+def stream_job_bundle(job_id):
+    return _save_job_bundle(secure_filename(job_id), request.stream)
+
+def _save_job_bundle(job_id, stream):
+    if _JOB_BUNDLE_MAX_SIZE and (request.content_length or 0) > _JOB_BUNDLE_MAX_SIZE:
+        return f'Job bundle exceeds {_JOB_BUNDLE_MAX_SIZE} bytes', 413
+
+    try:
+        sha256 = job_bundle_store.save(job_id, stream)
+    except ValueError:
         return 'Invalid job bundle', 400
+    except JobBundleTooLarge as error:
+        return str(error), 413
+
+    response = make_response('Job bundle uploaded', 200)
+    response.headers['X-Bundle-Sha256'] = sha256
+    return response
+
+# registered before the GET route below, which would otherwise answer HEAD requests as well
+@app.route('/job_bundle/<string:sha256>', methods=['HEAD'])
+def has_job_bundle(sha256):
+    if job_bundle_store.has_blob(sha256):
+        return make_response('', 200)
+    return make_response('', 404)
+
+@app.route('/job_bundle/<string:sha256>/jobs/<string:job_id>', methods=['PUT'])
+def link_job_bundle(sha256, job_id):
+    try:
+        job_bundle_store.link(sha256, secure_filename(job_id))
+    except KeyError:
+        return f"Job bundle {sha256} not found", 404
+    return make_response(jsonify(job_id), 201)
 
 @app.route('/job_bundle/<string:job_id>', methods=['GET'])
 def get_job_bundle(job_id):
-    import tarfile
-    import os
     from flask import send_file
     if not _archive_directory_exists(job_id):
         return f'No archive directory found for Job {job_id}', 404
 
-    try:
-        with tempfile.NamedTemporaryFile() as file:
-            with tarfile.open(fileobj=file, mode='w:gz') as tar:
-                tar.add(os.path.join(_ARCHIVE_DIR, job_id, 'artifacts'), arcname=job_id)
-            file.seek(0)
-            return send_file(file.name, attachment_filename=f'{job_id}.tgz')
-    except FileNotFoundError as e:
+    archive_format = request.args.get('format', 'tgz')
+    if archive_format not in ('tgz', 'tar'):
+        return f"Bad archive format {archive_format}", 400
+
+    artifacts_dir = os.path.join(_ARCHIVE_DIR, job_id, 'artifacts')
+    if not os.path.isdir(artifacts_dir):
         return f'The artifact directory was not found for Job {job_id}', 404
-    except PermissionError as e:
-        return f"{e}", 401
+    if not os.access(artifacts_dir, os.R_OK | os.X_OK):
+        return f"Permission denied: '{artifacts_dir}'", 401
+
+    cache_path, cached = cached_archive(job_id, artifacts_dir, archive_format)
+    if cached:
+        return send_file(cached, mimetype='application/x-tar', as_attachment=True,
+                         attachment_filename=f'{job_id}.{archive_format}')
+
+    response = Response(stream_with_context(stream_archive(artifacts_dir, job_id, archive_format, cache_path)),
+                        mimetype='application/x-tar')
+    response.headers['Content-Disposition'] = f'attachment; filename={job_id}.{archive_format}'
+    return response
 
 def _archive_directory_exists(job_id):
     import os
@@ -66,12 +110,7 @@ def _archive_directory_exists(job_id):
     return False
 
 def _is_job_bundle_valid_tar(job_id):
-    import os
-
-    try:
-        return tarfile.is_tarfile(os.path.join(_JOB_BUNDLE_STORE_DIR, f'{job_id}.tgz'))
-    except Exception:
-        return False
+    return job_bundle_store.is_valid(job_id)
 
 @app.route('/queued_jobs', methods=['GET', 'POST'])
 def queued_jobs():
@@ -81,22 +120,88 @@ def queued_jobs():
             return "Job must contain json payload", 400
 
         try:
-            queue.append({'queued_time': time(),
-                          'job_id': job['job_id'],
-                          'spec': job['spec'],
-                          'metadata': job.get('metadata', {}),
-                          'gpu_spec': job.get('gpu_spec', {})})
+            entry = _queued_job_entry(job, time())
         except KeyError:
             return "Bad job spec: job_id and spec are required", 400
+        queue.append(entry)
 
         if not _is_job_bundle_valid_tar(job['job_id']):
             return f"Job bundle {job['job_id']}.tgz not found", 400
 
-        tracker_clients.queued(queue[-1])
+        index_job(job['job_id'], 'queued')
+        job_bundle_store.prefetch(job['job_id'])
+        docker_worker_pool.prefetch_image(job['spec'].get('image'))
+        tracker_clients.queued(entry)
+        docker_worker_pool.notify_queue_changed()
 
         return make_response(jsonify(job['job_id']), 201)
     else:
-        return jsonify({i: {**val, 'position': i} for i, val in enumerate(queue)})
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', None, type=int)
+        fields = request.args.get('fields')
+        fields = fields.split(',') if fields else None
+
+        if offset < 0 or (limit is not None and limit < 0):
+            return "offset and limit must not be negative", 400
+
+        def queued_jobs_page():
+            position = offset
+            while limit is None or position < offset + limit:
+                batch_size = _QUEUE_PAGE_SIZE if limit is None else min(_QUEUE_PAGE_SIZE, offset + limit - position)
+                jobs = queue[position:position + batch_size]
+
+                for job in jobs:
+                    if fields is not None:
+                        job = {field: job[field] for field in fields if field in job}
+                    yield position, {**job, 'position': position}
+                    position += 1
+
+                if len(jobs) < batch_size:
+                    return
+
+        return Response(stream_with_context(_stream_json_object(queued_jobs_page())), mimetype='application/json')
+
+def _stream_json_object(items):
+    yield '{'
+    separator = ''
+    for key, value in items:
+        yield f'{separator}{json.dumps(str(key))}: {json.dumps(value)}'
+        separator = ', '
+    yield '}\n'
+
+def _queued_job_entry(job, queued_time):
+    return {'queued_time': queued_time,
+            'job_id': job['job_id'],
+            'spec': job['spec'],
+            'metadata': job.get('metadata', {}),
+            'gpu_spec': job.get('gpu_spec', {}),
+            'resource_spec': job.get('resource_spec', {})}
+
+@app.route('/queued_jobs/batch', methods=['POST'])
+def queue_job_batch():
+    jobs = request.json
+    if not jobs or not isinstance(jobs, list):
+        return "Batch must contain a json list of jobs", 400
+
+    queued_time = time()
+    try:
+        jobs = [_queued_job_entry(job, queued_time) for job in jobs]
+    except (KeyError, TypeError, AttributeError):
+        return "Bad job spec: job_id and spec are required", 400
+
+    missing_bundles = sorted(job_id for job_id in {job['job_id'] for job in jobs} if not _is_job_bundle_valid_tar(job_id))
+    if missing_bundles:
+        return f"Job bundles not found: {', '.join(f'{job_id}.tgz' for job_id in missing_bundles)}", 400
+
+    queue.extend(jobs)
+    index_queued_jobs(jobs)
+    for job in jobs:
+        job_bundle_store.prefetch(job['job_id'])
+        docker_worker_pool.prefetch_image(job['spec'].get('image'))
+    tracker_clients.queued_many(jobs)
+    docker_worker_pool.notify_queue_changed()
+
+    return make_response(jsonify([job['job_id'] for job in jobs]), 201)
 
 @app.route('/queued_jobs/<int:position>', methods=['GET'])
 def show_queued_job(position):
@@ -104,13 +209,15 @@ def show_queued_job(position):
 
 @app.route('/queued_jobs/<int:position>', methods=['DELETE'])
 def delete_queued_job(position):
-    # need to make thread safe
     try:
-        job = queue[position]
+        # a single pop, so that the job reported and unindexed is the one that was removed
+        job = queue.pop(position)
         job_id = job["job_id"]
-        del queue[position]
+        unindex_job(job_id)
+        docker_worker_pool.notify_queue_changed()
         tracker_clients.delete(job)
         docker_worker_pool.remove_working_directory(job_id)
+        job_bundle_store.remove(job_id)
     except IndexError:
         return f"Bad queue position {position}", 404
     return make_response(jsonify({}), 204)
@@ -118,11 +225,12 @@ def delete_queued_job(position):
 @app.route('/queued_jobs/<int:position>', methods=['PATCH'])
 def reposition_queued_job(position):
     queue.reposition(position, request.json)
+    docker_worker_pool.notify_queue_changed()
     return make_response(jsonify({}), 204)
 
 @app.route('/running_jobs', methods=['GET'])
 def show_running_jobs():
-    return jsonify({key: value for key, value in running_jobs.items()})
+    return jsonify({key: value for key, value in iter_items(running_jobs)})
 
 @app.route('/running_jobs/<string:job_id>', methods=['DELETE'])
 @forward('job_id', 'job_id')
@@ -139,15 +247,21 @@ def delete_completed_job(job_id):
     return _delete_job(job_id)
 
 def _delete_job(job_id):
-    job = None
     try:
-        if job_id in failed_jobs:
-            job = failed_jobs[job_id]
+        job = get_or_none(failed_jobs, job_id)
+        if job is not None:
             del failed_jobs[job_id]
-        elif job_id in completed_jobs:
-            job = completed_jobs[job_id]
-            del completed_jobs[job_id]
+        else:
+            job = get_or_none(completed_jobs, job_id)
+            if job is not None:
+                del completed_jobs[job_id]
+        unindex_job(job_id)
         tracker_clients.delete(job)
+        try:
+            del log_store[job_id]
+        except KeyError:
+            pass
+        job_bundle_store.remove(job_id)
         docker_worker_pool.delete_archive(job_id)
 
         return make_response(jsonify({}), 204)
@@ -161,7 +275,77 @@ def show_logs_running_jobs(job_id):
     worker = docker_worker_pool.worker_by_job_id(job_id)
     if worker is None:
         raise KeyError("Job id not found")
-    return jsonify(worker.logs())
+
+    if not any(parameter in request.args for parameter in ('since', 'follow', 'tail', 'timestamps')):
+        return jsonify(worker.logs())
+
+    try:
+        since = request.args.get('since')
+        since = float(since) if since is not None else None
+        tail = request.args.get('tail', 'all')
+        tail = int(tail) if tail != 'all' else tail
+    except ValueError:
+        return "since must be a unix timestamp and tail a number of lines or 'all'", 400
+
+    timestamps = request.args.get('timestamps', 'false').lower() == 'true'
+    # lines are timestamped whenever since is given so that the ones docker sends again can be dropped
+    chunks = worker.stream_logs(since=since,
+                                follow=request.args.get('follow', 'false').lower() == 'true',
+                                tail=tail,
+                                timestamps=timestamps or since is not None)
+    if chunks is None:
+        return f"Job {job_id} has not started yet", 404
+
+    lines = _decoded_lines(chunks)
+    if since is not None:
+        lines = _lines_after(lines, since, timestamps)
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return Response((f'data: {line}\n\n' for line in lines), mimetype='text/event-stream')
+    return Response((f'{line}\n' for line in lines), mimetype='text/plain')
+
+
+def _lines_after(lines, since, timestamps):
+    # docker rounds since down to the second; lines at or before since were already read by the client
+    try:
+        for line in lines:
+            timestamp, _, text = line.partition(' ')
+            try:
+                if _parse_log_timestamp(timestamp) <= since:
+                    continue
+            except ValueError:
+                pass
+            yield line if timestamps else text
+    finally:
+        lines.close()
+
+
+def _parse_log_timestamp(timestamp):
+    # RFC 3339 with nanoseconds, e.g. 2020-01-02T03:04:05.123456789Z
+    from calendar import timegm
+    from datetime import datetime
+
+    seconds = datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+    fraction = timestamp[19:].rstrip('Z')
+    return timegm(seconds.timetuple()) + (float(fraction) if fraction else 0)
+
+
+def _decoded_lines(chunks):
+    import codecs
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buffer = ''
+    try:
+        for chunk in chunks:
+            buffer += decoder.decode(chunk)
+            *lines, buffer = buffer.split('\n')
+            yield from lines
+        buffer += decoder.decode(b'', final=True)
+        if buffer:
+            yield buffer
+    finally:
+        # stop following the container when the client goes away
+        chunks.close()
 #
 #
 # @app.route('/running_jobs/<string:job_id>/log_path', methods=['GET'])
@@ -183,24 +367,75 @@ def show_container_id_running_jobs(job_id):
 
 @app.route('/completed_jobs', methods=['GET'])
 def show_completed_jobs():
-    result = {key: value for key, value in completed_jobs.items()}
-    logging.info(request.args.get("sort"))
-    if request.args.get("sort") is not None:
-        reverse = {"asc": False, "desc": True}
-        fields = [(field + ":asc").split(":")[0:2] for field in request.args.get("sort").split(",")]
-        logging.debug(fields)
-        for field in fields:
-            try:
-                result = sorted(result.items(), reverse=reverse[field[1]], key=lambda x: x[1][field[0]])
-            except KeyError:
-                return f"Bad sort request in {field}", 400
-    return jsonify(result)
+    return _query_jobs(completed_jobs)
+
+
+def _query_jobs(store):
+    try:
+        query = _job_query(request.args)
+    except ValueError as error:
+        return f"Bad query: {error}", 400
+
+    fields = request.args.get('fields')
+
+    try:
+        # backends that can filter and sort themselves are handed the whole query
+        if hasattr(store, 'query'):
+            jobs = store.query(**query)
+        else:
+            jobs = filter_jobs(iter_items(store), **query)
+    except (KeyError, TypeError):
+        return f"Bad sort request in {request.args.get('sort')}", 400
+
+    if fields:
+        fields = fields.split(',')
+        jobs = [(job_id, {field: job[field] for field in fields if field in job}) for job_id, job in jobs]
+
+    response = make_response(jsonify(jobs if query['sort'] else dict(jobs)))
+    if query['limit'] is not None and len(jobs) == query['limit']:
+        response.headers['X-Next-Cursor'] = str(query['offset'] + query['limit'])
+    return response
+
+
+def _job_query(args):
+    def optional(name, convert):
+        value = args.get(name)
+        try:
+            return convert(value) if value is not None else None
+        except ValueError:
+            raise ValueError(f"invalid {name} {value}")
+
+    sort = []
+    if args.get('sort'):
+        for field in args.get('sort').split(','):
+            name, direction = (field + ':asc').split(':')[0:2]
+            if direction not in ('asc', 'desc'):
+                raise ValueError(f"invalid sort direction in {field}")
+            sort.append((name, direction == 'desc'))
+
+    return {'project': args.get('project'),
+            'user': args.get('user'),
+            'since': optional('since', float),
+            'until': optional('until', float),
+            'status_code': optional('status_code', int),
+            'sort': sort,
+            'offset': optional('cursor', int) or 0,
+            'limit': optional('limit', int)}
+
+
+def _stored_logs(job):
+    # records written before logs were moved to the log store still hold the full logs
+    if 'log_ref' in job:
+        logs = log_store.load(job['job_id'])
+        if logs is not None:
+            return logs
+    return job.get('logs')
 
 
 @app.route('/completed_jobs/<string:job_id>/logs', methods=['GET'])
 def show_logs_completed_jobs(job_id):
     try:
-        response = jsonify(completed_jobs[job_id]['logs'])
+        response = jsonify(_stored_logs(completed_jobs[job_id]))
     except KeyError:
         return f"Bad job id {job_id}", 404
     return response
@@ -208,18 +443,19 @@ def show_logs_completed_jobs(job_id):
 
 @app.route('/failed_jobs', methods=['GET'])
 def show_failed_jobs():
-    return jsonify({key: value for key, value in failed_jobs.items()})
+    return _query_jobs(failed_jobs)
 
 
 @app.route('/failed_jobs/<string:job_id>/logs', methods=['GET'])
 def show_logs_failed_jobs(job_id):
-    return jsonify(failed_jobs[job_id]['logs'])
+    return jsonify(_stored_logs(failed_jobs[job_id]))
 
 
 @app.route('/workers', methods=['GET', 'POST'])
 def workers():
     if request.method == 'POST':
         worker_id = docker_worker_pool.add()
+        docker_worker_pool.notify_queue_changed()
         return make_response(jsonify(worker_id), 201)
     else:
         workers_list = app.apscheduler.get_jobs()
@@ -232,6 +468,14 @@ def workers():
                                    }
         return jsonify(response)
 
+@app.route('/tracker_metrics', methods=['GET'])
+def show_tracker_metrics():
+    return jsonify(tracker_clients.metrics())
+
+@app.route('/resources', methods=['GET'])
+def show_resources():
+    return jsonify({'gpus': dict(gpu_pool), **resource_pool.status()})
+
 @app.route('/workers/<int:worker_id>', methods=['DELETE'])
 def delete_worker(worker_id):
     try:
@@ -243,42 +487,73 @@ def delete_worker(worker_id):
 @app.route('/jobs/<string:job_id>', methods=['GET'])
 @forward('job_id', 'job_id')
 def get_job(job_id):
-    if job_id in failed_jobs:
-        response = {
-            "job_id": job_id,
-            "logs": failed_jobs[job_id]['logs'],
-            "status": "failed",
-            "spec": failed_jobs[job_id]['spec']
-        }
-        return make_response(jsonify(response), 200)
-
-    if job_id in completed_jobs:
-        response = {
-            "job_id": job_id,
-            "logs": completed_jobs[job_id]['logs'],
-            "status": "completed",
-            "spec": completed_jobs[job_id]['spec']
-        }
-        return make_response(jsonify(response), 200)
+    response = _indexed_job_response(job_id) or _searched_job_response(job_id)
+    if response is None:
+        return f"Bad job id {job_id}", 404
+    return make_response(jsonify(response), 200)
+
+
+def _job_response(job_id, status, spec, logs):
+    return {
+        "job_id": job_id,
+        "logs": logs,
+        "status": status,
+        "spec": spec
+    }
+
+
+def _indexed_job_response(job_id):
+    try:
+        entry = job_index[job_id]
+    except KeyError:
+        return None
+
+    try:
+        if entry['state'] == 'failed':
+            job = failed_jobs[job_id]
+            return _job_response(job_id, 'failed', job['spec'], _stored_logs(job))
+
+        if entry['state'] == 'completed':
+            job = completed_jobs[job_id]
+            return _job_response(job_id, 'completed', job['spec'], _stored_logs(job))
+
+        if entry['state'] == 'running':
+            worker = docker_worker_pool.worker_by_id(entry['worker_id'])
+            job = worker.job if worker is not None else None
+            if job is not None and job['job_id'] == job_id:
+                return _job_response(job_id, worker.status, job['spec'], worker.logs())
+
+        if entry['state'] == 'queued':
+            # the position of a job changes, so queued jobs are only indexed by state
+            job = _queued_job(job_id)
+            if job is not None:
+                return _job_response(job_id, 'queued', job['spec'], "")
+    except KeyError:
+        pass
+
+    # the index is out of date; fall back to searching every store
+    return None
+
+
+def _searched_job_response(job_id):
+    job = get_or_none(failed_jobs, job_id)
+    if job is not None:
+        return _job_response(job_id, 'failed', job['spec'], _stored_logs(job))
+
+    job = get_or_none(completed_jobs, job_id)
+    if job is not None:
+        return _job_response(job_id, 'completed', job['spec'], _stored_logs(job))
 
     worker = docker_worker_pool.worker_by_job_id(job_id)
     if worker:
-        response = {
-            "job_id": job_id,
-            "logs": worker.logs(),
-            "status": worker.status,
-            "spec": worker.job['spec']
-        }
-        return make_response(jsonify(response), 200)
-
-    for job in queue:
-        if job['job_id'] == job_id:
-            response = {
-                "job_id": job_id,
-                "logs": "",
-                "status": "queued",
-                "spec": job['spec']
-            }
-            return make_response(jsonify(response), 200)
-
-    return f"Bad job id {job_id}", 404
+        return _job_response(job_id, worker.status, worker.job['spec'], worker.logs())
+
+    job = _queued_job(job_id)
+    if job is not None:
+        return _job_response(job_id, 'queued', job['spec'], "")
+
+    return None
+
+
+def _queued_job(job_id):
+    return next((job for job in queue if job['job_id'] == job_id), None)
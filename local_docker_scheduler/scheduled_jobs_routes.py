@@ -52,7 +52,8 @@ def create_scheduled_job():
                         'spec': spec,
                         'schedule': schedule,
                         'metadata': scheduled_job.get('metadata', {}),
-                        'gpu_spec': scheduled_job.get('gpu_spec', {})}
+                        'gpu_spec': scheduled_job.get('gpu_spec', {}),
+                        'resource_spec': scheduled_job.get('resource_spec', {})}
 
     try:
         docker_worker_pool.add_cron_worker(scheduled_job)
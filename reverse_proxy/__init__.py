@@ -41,13 +41,16 @@ def _proxy(new_host_url):
         headers={key: value for (key, value) in request.headers if key != 'Host'},
         data=request.get_data(),
         cookies=request.cookies,
-        allow_redirects=False)
+        allow_redirects=False,
+        stream=True)
 
     excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
     headers = [(name, value) for (name, value) in resp.raw.headers.items()
                if name.lower() not in excluded_headers]
 
-    response = Response(resp.content, resp.status_code, headers)
+    # passed on as it arrives, so that followed logs and large downloads are not buffered on this node
+    response = Response(resp.iter_content(chunk_size=None), resp.status_code, headers)
+    response.call_on_close(resp.close)
     return response
 
 
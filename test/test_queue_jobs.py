@@ -59,7 +59,11 @@ class TestQueueJobs(unittest.TestCase):
             for f in archive_files + working_dir_files:
                 shutil.rmtree(f)
             for f in job_bundle_dir_files:
-                os.remove(f)
+                # the store keeps blobs/ and extracted/ next to the job bundle links
+                if os.path.isdir(f) and not os.path.islink(f):
+                    shutil.rmtree(f)
+                else:
+                    os.remove(f)
         except Exception as e:
             print('Unable to delete jobs at the end of the test:', str(e))
 
@@ -177,7 +181,7 @@ class TestQueueJobs(unittest.TestCase):
         response = requests.delete(f'http://localhost:5000/queued_jobs/{job_id}')
         return response
 
-    def _job_payload(self, job_bundle_name, fail=False, sleep_in_seconds=0):
+    def _job_payload(self, job_bundle_name, fail=False, sleep_in_seconds=0, project_name='test', username='shaz'):
         host_working_dir = self.working_dir_path
         host_archive_dir = self.archives_dir_path
 
@@ -209,7 +213,7 @@ class TestQueueJobs(unittest.TestCase):
                     'python ${ENTRYPOINT} && chmod -R a+rw /job/job_archive && sleep ${SECONDS}'
                 ]
             },
-            'metadata': {'project_name': 'test', 'username': 'shaz'},
+            'metadata': {'project_name': project_name, 'username': username},
             'gpu_spec': {}
         }
 
@@ -267,6 +271,28 @@ class TestQueueJobs(unittest.TestCase):
 
         self.assertEqual(400, response.status_code)
 
+    def test_queuing_batch_of_jobs_with_proper_payloads_and_bundles_gives_201(self):
+        import requests
+
+        job_bundle_names = [self._create_job('fake_job') for _ in range(2)]
+        job_payloads = [self._job_payload(job_bundle_name) for job_bundle_name in job_bundle_names]
+
+        response = requests.post('http://localhost:5000/queued_jobs/batch', json=job_payloads)
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(job_bundle_names, response.json())
+
+    def test_queuing_batch_of_jobs_with_a_missing_bundle_gives_400_and_queues_nothing(self):
+        import requests
+
+        job_bundle_name = self._create_job('fake_job')
+        job_payloads = [self._job_payload(job_bundle_name), self._job_payload('123')]
+
+        response = requests.post('http://localhost:5000/queued_jobs/batch', json=job_payloads)
+
+        self.assertEqual(400, response.status_code)
+        self.assertNotIn(job_bundle_name, [value['job_id'] for job_pos, value in self._queued_jobs().json().items()])
+
     def test_queued_job_has_completed(self):
         import time
 
@@ -327,6 +353,70 @@ class TestQueueJobs(unittest.TestCase):
         self.assertEqual(200, response.status_code)
         self.assertEqual(response.json()['status'], 'failed')
 
+    def _wait_for_completed_jobs(self, job_ids, timeout=60):
+        import time
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if set(job_ids) <= set(self._completed_jobs().json()):
+                return
+            time.sleep(1)
+        self.fail(f'jobs {job_ids} did not complete in {timeout} seconds')
+
+    def test_completed_jobs_can_be_filtered_sorted_and_paged(self):
+        import requests
+        import uuid
+
+        project, other_project = f'project-{uuid.uuid4()}', f'project-{uuid.uuid4()}'
+        jobs = {}
+        for name, project_name, username in [('first', project, 'alice'), ('second', project, 'bob'),
+                                             ('third', project, 'alice'), ('other', other_project, 'alice')]:
+            jobs[name] = self._create_job('fake_job')
+            self._queue_job(self._job_payload(jobs[name], project_name=project_name, username=username))
+
+        self._wait_for_completed_jobs(jobs.values())
+        alices = sorted([jobs['first'], jobs['third']])
+
+        response = requests.get('http://localhost:5000/completed_jobs', params={'project': project})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({jobs['first'], jobs['second'], jobs['third']}, set(response.json()))
+
+        response = requests.get('http://localhost:5000/completed_jobs', params={'project': project, 'user': 'alice'})
+        self.assertEqual(set(alices), set(response.json()))
+
+        response = requests.get('http://localhost:5000/completed_jobs', params={'project': project, 'status_code': 0})
+        self.assertEqual(3, len(response.json()))
+        response = requests.get('http://localhost:5000/completed_jobs', params={'project': project, 'status_code': 1})
+        self.assertEqual({}, response.json())
+
+        # ties on the first key are ordered by the second one
+        response = requests.get('http://localhost:5000/completed_jobs',
+                                params={'project': project, 'sort': 'metadata.username:desc,job_id:asc'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([jobs['second']] + alices, [job_id for job_id, _ in response.json()])
+
+        response = requests.get('http://localhost:5000/completed_jobs',
+                                params={'project': project, 'user': 'alice', 'sort': 'job_id', 'limit': 1})
+        self.assertEqual(alices[:1], [job_id for job_id, _ in response.json()])
+        self.assertEqual('1', response.headers['X-Next-Cursor'])
+
+        response = requests.get('http://localhost:5000/completed_jobs',
+                                params={'project': project, 'user': 'alice', 'sort': 'job_id', 'limit': 1,
+                                        'cursor': response.headers['X-Next-Cursor']})
+        self.assertEqual(alices[1:], [job_id for job_id, _ in response.json()])
+
+        response = requests.get('http://localhost:5000/completed_jobs',
+                                params={'project': project, 'user': 'alice', 'sort': 'job_id', 'limit': 1, 'cursor': 2})
+        self.assertEqual([], response.json())
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_completed_jobs_query_with_bad_parameters_gives_400(self):
+        import requests
+
+        for params in [{'limit': 'many'}, {'cursor': 'next'}, {'status_code': 'zero'}, {'sort': 'job_id:sideways'}]:
+            response = requests.get('http://localhost:5000/completed_jobs', params=params)
+            self.assertEqual(400, response.status_code, params)
+
     def test_running_job_status(self):
         import time
 
@@ -388,6 +478,22 @@ class TestQueueJobs(unittest.TestCase):
         self.assertEqual(200, response.status_code)
         self.assertEqual(response.json()['status'], 'queued')
 
+    def test_queued_jobs_can_be_paginated_and_projected(self):
+        import requests
+        import time
+
+        job_bundle_names = []
+        for _ in range(3):
+            job_bundle_name = self._create_job('fake_job')
+            self._queue_job(self._job_payload(job_bundle_name, sleep_in_seconds=5))
+            job_bundle_names.append(job_bundle_name)
+
+        time.sleep(3)
+
+        response = requests.get('http://localhost:5000/queued_jobs', params={'offset': 1, 'limit': 1, 'fields': 'job_id'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'1': {'job_id': job_bundle_names[2], 'position': 1}}, response.json())
+
     def _restart_server(self):
         import time
         self._stop_server()
@@ -0,0 +1,274 @@
+import unittest
+from unittest import mock
+
+
+def _connect_to(server):
+    import fakeredis
+    from db import redis_connection
+
+    return mock.patch.object(redis_connection, 'connect',
+                             lambda *args, **kwargs: fakeredis.FakeStrictRedis(server=server))
+
+
+class TestRedisList(unittest.TestCase):
+
+    def setUp(self):
+        import fakeredis
+
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeStrictRedis(server=self.server)
+        self.queue = self._redis_list()
+
+    def _redis_list(self, key='queue', **kwargs):
+        from db import redis_connection
+
+        with _connect_to(self.server):
+            return redis_connection.RedisList(key, 'localhost', 6379, **kwargs)
+
+    def _scores(self):
+        return [score for _, score in self.redis.zrange('queue:order', 0, -1, withscores=True)]
+
+    def test_append_and_extend_keep_order(self):
+        self.queue.append('a')
+        self.queue.extend(['b', 'c'])
+        self.queue.extend([])
+
+        self.assertEqual(3, len(self.queue))
+        self.assertEqual(['a', 'b', 'c'], list(self.queue))
+
+    def test_identical_values_stay_distinct(self):
+        self.queue.extend([{'job_id': 'a'}, {'job_id': 'a'}])
+        self.queue.pop(0)
+
+        self.assertEqual([{'job_id': 'a'}], list(self.queue))
+
+    def test_insert(self):
+        self.queue.extend(['a', 'c'])
+        self.queue.insert(1, 'b')
+        self.queue.insert(0, 'start')
+
+        self.assertEqual(['start', 'a', 'b', 'c'], list(self.queue))
+
+    def test_insert_out_of_range(self):
+        self.queue.append('a')
+
+        with self.assertRaises(IndexError):
+            self.queue.insert(5, 'b')
+        self.assertEqual(['a'], list(self.queue))
+
+    def test_reposition(self):
+        self.queue.extend(['a', 'b', 'c', 'd'])
+
+        self.queue.reposition(3, 0)
+        self.assertEqual(['d', 'a', 'b', 'c'], list(self.queue))
+        self.queue.reposition(0, 2)
+        self.assertEqual(['a', 'b', 'd', 'c'], list(self.queue))
+
+    def test_reposition_out_of_range_leaves_queue_unchanged(self):
+        self.queue.extend(['a', 'b', 'c'])
+
+        with self.assertRaises(IndexError):
+            self.queue.reposition(5, 0)
+        with self.assertRaises(IndexError):
+            self.queue.reposition(0, 5)
+        self.assertEqual(['a', 'b', 'c'], list(self.queue))
+        self.assertEqual(3, len(self.queue))
+
+    def test_repeated_inserts_renumber_scores_when_precision_runs_out(self):
+        self.queue.extend(['first', 'last'])
+        for i in range(100):
+            self.queue.insert(1, i)
+
+        self.assertEqual(['first'] + list(range(99, -1, -1)) + ['last'], list(self.queue))
+        scores = self._scores()
+        self.assertEqual(sorted(set(scores)), scores)
+
+    def test_negative_indices_and_slices(self):
+        self.queue.extend(['a', 'b', 'c', 'd'])
+
+        self.assertEqual('d', self.queue[-1])
+        self.assertEqual(['b', 'c'], self.queue[1:3])
+        self.assertEqual(['c', 'd'], self.queue[-2:])
+        self.assertEqual(['a', 'b', 'c'], self.queue[:-1])
+        self.assertEqual([], self.queue[:0])
+        with self.assertRaises(IndexError):
+            self.queue[4]
+        with self.assertRaises(ValueError):
+            self.queue[::2]
+
+    def test_set_and_delete(self):
+        self.queue.extend(['a', 'b', 'c'])
+
+        self.queue[1] = 'B'
+        del self.queue[-1]
+
+        self.assertEqual(['a', 'B'], list(self.queue))
+        with self.assertRaises(IndexError):
+            del self.queue[2]
+        with self.assertRaises(IndexError):
+            self.queue.pop(2)
+
+    def test_pop_item_of_window_after_the_queue_changed(self):
+        self.queue.extend(['a', 'b', 'c'])
+        window = self.queue.window(2)
+        self.assertEqual(['a', 'b'], [value for _, value in window])
+
+        # another scheduler takes the head first
+        self.assertEqual('a', self.queue.pop(0))
+
+        self.assertIsNone(self.queue.pop_item(window[0][0]))
+        self.assertEqual('b', self.queue.pop_item(window[1][0]))
+        self.assertEqual(['c'], list(self.queue))
+
+    def test_changes_are_published(self):
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe('queue:events')
+
+        self.queue.extend(['a', 'b'])
+        self.queue.insert(0, 'c')
+        self.queue.reposition(0, 1)
+        self.queue.pop(0)
+        del self.queue[0]
+
+        events = []
+        message = pubsub.get_message()
+        while message is not None:
+            if message['type'] == 'message':
+                events.append(message['data'])
+            message = pubsub.get_message()
+        self.assertEqual([b'append', b'insert', b'reposition', b'remove', b'remove'], events)
+
+    def test_queue_stored_as_a_list_is_converted(self):
+        import pickle
+
+        self.redis.rpush('legacy', *[pickle.dumps(value) for value in ['a', 'b', 'a']])
+        queue = self._redis_list('legacy')
+
+        self.assertEqual(['a', 'b', 'a'], list(queue))
+        self.assertEqual(b'zset', self.redis.type('legacy:order'))
+        self.assertFalse(self.redis.exists('legacy'))
+
+        queue.append('c')
+        self.assertEqual(['a', 'b', 'a', 'c'], list(queue))
+
+    def _job(self, job_id, gpus=0, cpus=0, memory=0):
+        return {'job_id': job_id, 'gpu_spec': {'num_gpus': gpus}, 'resource_spec': {'cpus': cpus, 'memory': memory}}
+
+    def test_pop_first_fit_prefers_the_head_then_the_fullest_fit(self):
+        from db.resource_ledger import job_requirements
+
+        self.queue.requirements = job_requirements
+        self.queue.extend([self._job('big', gpus=2), self._job('small', cpus=1), self._job('medium', cpus=2)])
+        free, capacity = (1, 4, None), (2, 8, None)
+
+        job, skipped_head = self.queue.pop_first_fit(3, free, capacity)
+        self.assertEqual('medium', job['job_id'])
+        self.assertIsNotNone(skipped_head)
+
+        job, _ = self.queue.pop_first_fit(3, free, capacity, blocked_head=skipped_head)
+        self.assertIsNone(job)
+
+        job, skipped_head = self.queue.pop_first_fit(3, (2, 4, None), capacity)
+        self.assertEqual('big', job['job_id'])
+        self.assertIsNone(skipped_head)
+
+        self.assertEqual('small', self.queue.pop_first_fit(3, free, capacity)[0]['job_id'])
+        with self.assertRaises(IndexError):
+            self.queue.pop_first_fit(3, free, capacity)
+
+    def test_pop_first_fit_pops_invalid_jobs_and_records_missing_requirements(self):
+        from db.resource_ledger import job_requirements
+
+        # queued without requirements, as by an earlier version
+        self.queue.append(self._job('unrecorded', gpus=1))
+        self.queue.requirements = job_requirements
+        self.queue.extend([self._job('invalid', gpus='many'), self._job('too_big', cpus=16)])
+
+        self.assertEqual('invalid', self.queue.pop_first_fit(3, (0, 4, None), (1, 8, None))[0]['job_id'])
+        self.assertEqual('too_big', self.queue.pop_first_fit(3, (0, 4, None), (1, 8, None))[0]['job_id'])
+        self.assertIsNone(self.queue.pop_first_fit(3, (0, 4, None), (1, 8, None))[0])
+        self.assertEqual('unrecorded', self.queue.pop_first_fit(3, (1, 4, None), (1, 8, None))[0]['job_id'])
+        self.assertEqual(0, self.redis.hlen('queue:requirements'))
+
+
+class TestRedisDict(unittest.TestCase):
+
+    def setUp(self):
+        import fakeredis
+
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeStrictRedis(server=self.server)
+
+    def _redis_dict(self, **codec):
+        from db import redis_connection
+
+        with _connect_to(self.server):
+            return redis_connection.RedisDict('jobs', 'localhost', 6379, codec=codec or None)
+
+    def _skip_without(self, module):
+        try:
+            __import__(module)
+        except ImportError:
+            self.skipTest(f'needs the {module} package')
+
+    def test_values_written_with_another_codec_can_be_read(self):
+        pickled = self._redis_dict()
+        as_json = self._redis_dict(format='json')
+        pickled['a'] = {'job_id': 'a', 'spec': {'image': 'python'}}
+        as_json['b'] = {'job_id': 'b'}
+
+        expected = {'a': {'job_id': 'a', 'spec': {'image': 'python'}}, 'b': {'job_id': 'b'}}
+        self.assertEqual(expected, dict(pickled.items()))
+        self.assertEqual(expected, dict(as_json.iter_items()))
+        self.assertEqual({'job_id': 'a', 'spec': {'image': 'python'}}, pickled['a'])
+        self.assertEqual({'job_id': 'b'}, as_json['b'])
+
+    def test_json_values_are_tagged(self):
+        store = self._redis_dict(format='json')
+        store['a'] = {'job_id': 'a'}
+
+        self.assertEqual(b'j{"job_id":"a"}', self.redis.hget('jobs', 'a'))
+        self.assertEqual(['a'], store.keys())
+
+    def test_msgpack_and_zstd_values_round_trip(self):
+        self._skip_without('msgpack')
+        self._skip_without('zstandard')
+
+        store = self._redis_dict(format='msgpack', compression='zstd')
+        store['a'] = {'job_id': 'a', 'gpu_ids': [0, 1]}
+
+        self.assertEqual({'job_id': 'a', 'gpu_ids': [0, 1]}, store['a'])
+        self.assertEqual(b'z', self.redis.hget('jobs', 'a')[:1])
+        self.assertEqual({'job_id': 'a', 'gpu_ids': [0, 1]}, self._redis_dict()['a'])
+
+    def test_migration_rewrites_fields_and_values(self):
+        pickled = self._redis_dict()
+        pickled.update({'a': {'job_id': 'a'}, 'b': {'job_id': 'b'}})
+
+        as_json = self._redis_dict(format='json')
+        self.assertIsNone(as_json.get_or_none('a'))
+        self.assertEqual(2, as_json.migrate(batch_size=1))
+
+        self.assertEqual({b'a', b'b'}, set(self.redis.hkeys('jobs')))
+        self.assertEqual(b'j{"job_id":"a"}', self.redis.hget('jobs', 'a'))
+        self.assertEqual({'job_id': 'a'}, as_json['a'])
+
+        # the job ids are now plain strings, which a store still configured for pickle does not look up
+        self.assertIsNone(pickled.get_or_none('a'))
+        self.assertNotIn('a', pickled)
+        self.assertEqual({'a': {'job_id': 'a'}, 'b': {'job_id': 'b'}}, dict(pickled.items()))
+
+    def test_migrating_the_queue_keeps_ids_and_order(self):
+        from db import redis_connection
+
+        with _connect_to(self.server):
+            pickled = redis_connection.RedisList('queue', 'localhost', 6379)
+            pickled.extend([{'job_id': 'a'}, {'job_id': 'b'}])
+            as_json = redis_connection.RedisList('queue', 'localhost', 6379, codec={'format': 'json'})
+
+        ids = self.redis.zrange('queue:order', 0, -1)
+        self.assertEqual(2, as_json.migrate())
+
+        self.assertEqual(ids, self.redis.zrange('queue:order', 0, -1))
+        self.assertEqual(b'j', self.redis.hget('queue:items', ids[0])[:1])
+        self.assertEqual([{'job_id': 'a'}, {'job_id': 'b'}], list(pickled))
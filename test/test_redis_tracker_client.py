@@ -0,0 +1,128 @@
+import unittest
+from unittest import mock
+
+
+class TestRedisTrackerClient(unittest.TestCase):
+
+    def setUp(self):
+        import os.path as path
+        import tempfile
+        import fakeredis
+        import tracker_client_plugins.redis_tracker_client as redis_tracker_client
+
+        self.directory = tempfile.mkdtemp()
+        self.redis = fakeredis.FakeStrictRedis()
+        with mock.patch.object(redis_tracker_client, 'connect', lambda *args, **kwargs: self.redis):
+            self.client = redis_tracker_client.RedisTrackerClient('localhost', 6379, failure_threshold=2,
+                                                                  reset_timeout=3600,
+                                                                  spool_path=path.join(self.directory, 'spool.jsonl'))
+        self.send = self.client._send
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _job(self, job_id='job'):
+        return {'job_id': job_id, 'metadata': {'project_name': 'project', 'username': 'user'}}
+
+    def _fail(self, *args):
+        import redis
+
+        raise redis.exceptions.ConnectionError('tracker is down')
+
+    def _close_circuit(self):
+        self.client._opened_at -= self.client._reset_timeout + 1
+
+    def test_circuit_opens_after_repeated_failures(self):
+        with mock.patch.object(self.client, '_send', side_effect=self._fail) as send:
+            self.client.queued(self._job())
+            self.assertFalse(self.client._circuit_open())
+            self.client.running(self._job())
+            self.assertTrue(self.client._circuit_open())
+
+            # the spooled events are not retried while the circuit is open
+            self.client.completed(self._job())
+            self.assertEqual(2, send.call_count)
+
+        self.assertEqual(['queued', 'running', 'completed'],
+                         [method for method, _, _ in self.client._spool._read()])
+
+    def test_spooled_events_are_replayed_in_order_once_the_tracker_is_back(self):
+        with mock.patch.object(self.client, '_send', side_effect=self._fail):
+            self.client.queued(self._job())
+            self.client.running(self._job())
+
+        self._close_circuit()
+        self.client.completed(self._job())
+
+        self.assertFalse(self.client._spool)
+        self.assertFalse(self.client._circuit_open())
+        self.assertEqual(b'completed', self.redis.get('jobs:job:state'))
+        self.assertFalse(self.redis.sismember('projects:global:jobs:queued', 'job'))
+        self.assertTrue(self.redis.exists('jobs:job:creation_time'))
+
+    def test_failed_trial_keeps_the_spool_and_reopens_the_circuit(self):
+        with mock.patch.object(self.client, '_send', side_effect=self._fail):
+            self.client.queued(self._job())
+            self.client.running(self._job())
+            self._close_circuit()
+            self.client.completed(self._job())
+
+        self.assertTrue(self.client._circuit_open())
+        self.assertEqual(['queued', 'running', 'completed'],
+                         [method for method, _, _ in self.client._spool._read()])
+
+    def test_events_tracked_while_sending_are_spooled_behind(self):
+        def send_while_tracking(events):
+            self.client.failed(self._job('other'))
+            self.send(events)
+
+        with mock.patch.object(self.client, '_send', side_effect=send_while_tracking):
+            self.client.queued(self._job())
+
+        self.assertEqual(['failed'], [method for method, _, _ in self.client._spool._read()])
+        self.client.delete(self._job())
+        self.assertFalse(self.client._spool)
+        self.assertEqual(b'failed', self.redis.get('jobs:other:state'))
+
+
+class TestEventSpool(unittest.TestCase):
+
+    def setUp(self):
+        import os.path as path
+        import tempfile
+        from tracker_client_plugins.redis_tracker_client.spool import EventSpool
+
+        self.directory = tempfile.mkdtemp()
+        self.spool = EventSpool(path.join(self.directory, 'spool', 'events.jsonl'))
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _events(self, *methods):
+        return [(method, [{'job_id': method}], float(i)) for i, method in enumerate(methods)]
+
+    def test_replay_sends_in_batches_and_empties_the_spool(self):
+        self.spool.append(self._events('a', 'b', 'c'))
+        batches = []
+
+        self.assertEqual(3, self.spool.replay(batches.append, batch_size=2))
+        self.assertEqual([['a', 'b'], ['c']], [[method for method, _, _ in batch] for batch in batches])
+        self.assertFalse(self.spool)
+
+    def test_replay_keeps_unsent_and_newly_appended_events(self):
+        self.spool.append(self._events('a', 'b', 'c'))
+
+        def send(batch):
+            if batch[0][0] == 'b':
+                raise ConnectionError
+            # appended by another thread while the replay is sending
+            self.spool.append(self._events('d'))
+
+        with self.assertRaises(ConnectionError):
+            self.spool.replay(send, batch_size=1)
+
+        self.assertEqual(['b', 'c', 'd'], [method for method, _, _ in self.spool._read()])
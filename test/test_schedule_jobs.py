@@ -61,7 +61,11 @@ class TestScheduleJobs(unittest.TestCase):
             for f in archive_files + working_dir_files:
                 shutil.rmtree(f)
             for f in job_bundle_dir_files:
-                os.remove(f)
+                # the store keeps blobs/ and extracted/ next to the job bundle links
+                if os.path.isdir(f) and not os.path.islink(f):
+                    shutil.rmtree(f)
+                else:
+                    os.remove(f)
         except Exception as e:
             print('Unable to delete jobs at the end of the test:', str(e))
 
@@ -0,0 +1,96 @@
+import unittest
+
+
+class TestSqliteJobStore(unittest.TestCase):
+
+    def setUp(self):
+        import os.path as path
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+        self.location = path.join(self.directory, 'jobs.sqlite')
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _store(self, **kwargs):
+        from db.sqlite_job_store import SqliteJobStore
+
+        store = SqliteJobStore(self.location, 'jobs', **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def _job(self, job_id, project='project', user='user', end_time=0, status_code=0, **fields):
+        return {'job_id': job_id, 'metadata': {'project_name': project, 'username': user}, 'end_time': end_time,
+                'return_code': {'StatusCode': status_code}, **fields}
+
+    def _count_committed(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.location)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_query_filters_in_sqlite(self):
+        store = self._store()
+        store.update({'a': self._job('a', project='p1', end_time=1),
+                      'b': self._job('b', project='p1', user='other', end_time=2),
+                      'c': self._job('c', project='p2', end_time=3, status_code=1)})
+
+        self.assertEqual(['a', 'b'], sorted(job_id for job_id, _ in store.query(project='p1')))
+        self.assertEqual(['b'], [job_id for job_id, _ in store.query(project='p1', user='other')])
+        self.assertEqual(['b', 'c'], sorted(job_id for job_id, _ in store.query(since=2)))
+        self.assertEqual(['a'], [job_id for job_id, _ in store.query(until=2)])
+        self.assertEqual(['c'], [job_id for job_id, _ in store.query(status_code=1)])
+        self.assertEqual({'a', 'b', 'c'}, {job['job_id'] for _, job in store.query()})
+
+    def test_query_sorts_and_pages(self):
+        store = self._store()
+        store.update({job_id: self._job(job_id, project=project, end_time=end_time)
+                      for job_id, project, end_time in [('a', 'p2', 1), ('b', 'p1', 2), ('c', 'p2', 3), ('d', 'p1', 4)]})
+
+        sort = [('metadata.project_name', False), ('end_time', True)]
+        self.assertEqual(['d', 'b', 'c', 'a'], [job_id for job_id, _ in store.query(sort=sort)])
+        self.assertEqual(['b', 'c'], [job_id for job_id, _ in store.query(sort=sort, offset=1, limit=2)])
+        self.assertEqual(['c', 'a'], [job_id for job_id, _ in store.query(sort=sort, offset=2)])
+
+    def test_query_sorts_on_fields_without_a_column(self):
+        store = self._store()
+        store.update({job_id: self._job(job_id, rank=rank) for job_id, rank in [('a', 3), ('b', 1), ('c', 2)]})
+
+        self.assertEqual(['b', 'c'], [job_id for job_id, _ in store.query(sort=[('rank', False)], limit=2)])
+
+    def test_iter_items_pages_through_every_job(self):
+        store = self._store()
+        job_ids = ['', 'a', 'b', 'c', 'd']
+        store.update({job_id: self._job(job_id) for job_id in job_ids})
+
+        for batch in [1, 2, 5, 10]:
+            self.assertEqual(job_ids, [job_id for job_id, _ in store.iter_items(batch=batch)])
+        self.assertEqual(job_ids, [job['job_id'] for _, job in store.iter_items(batch=2)])
+
+    def test_writes_are_committed_in_batches(self):
+        store = self._store(commit_batch_size=2, commit_interval=3600)
+
+        store['a'] = self._job('a')
+        self.assertEqual(0, self._count_committed())
+        store['b'] = self._job('b')
+        self.assertEqual(2, self._count_committed())
+
+        store['c'] = self._job('c')
+        store.commit()
+        self.assertEqual(3, self._count_committed())
+
+    def test_close_commits_pending_writes_and_can_be_repeated(self):
+        store = self._store(commit_batch_size=100, commit_interval=3600)
+
+        store['a'] = self._job('a')
+        store.close()
+        self.assertEqual(1, self._count_committed())
+
+        store.close()
+        store.commit()
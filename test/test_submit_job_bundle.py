@@ -12,10 +12,13 @@ class TestSubmitJobBundle(unittest.TestCase):
         random_string = str(uuid.uuid4())[:8] 
 
         cls.working_dir_path = f'/tmp/local_docker_scheduler/working_dir_{random_string}'
+        cls.job_bundle_store_dir_path = f'/tmp/local_docker_scheduler/job_bundle_store_dir_{random_string}'
         os.makedirs(cls.working_dir_path)
+        os.makedirs(cls.job_bundle_store_dir_path)
 
         env = os.environ.copy()
         env['WORKING_DIR'] = cls.working_dir_path
+        env['JOB_BUNDLE_STORE_DIR'] = cls.job_bundle_store_dir_path
         env['NUM_WORKERS'] = '0'
         cls._server_process = Popen(['python', '-m', 'local_docker_scheduler', '-p', '5000'], env=env)
         time.sleep(3)
@@ -27,6 +30,9 @@ class TestSubmitJobBundle(unittest.TestCase):
         cls._server_process.terminate()
         cls._server_process.wait()
 
+        shutil.rmtree(cls.working_dir_path, ignore_errors=True)
+        shutil.rmtree(cls.job_bundle_store_dir_path, ignore_errors=True)
+
     def setUp(self):
         self._job_id = None
 
@@ -130,4 +136,148 @@ class TestSubmitJobBundle(unittest.TestCase):
         os.remove(tarball_location)
 
         self.assertEqual(400, response.status_code)
-        self.assertEqual('Invalid job bundle', response.text)
\ No newline at end of file
+        self.assertEqual('Invalid job bundle', response.text)
+
+    def test_uploaded_bundle_can_be_found_by_hash_and_reused_for_another_job(self):
+        import os
+        import uuid
+        import requests
+
+        tarball_location = self._generate_tarball()
+
+        with open(tarball_location, 'rb') as tarball:
+            response = requests.post('http://localhost:5000/job_bundle', files={'job_bundle': tarball})
+
+        os.remove(tarball_location)
+        sha256 = response.headers['X-Bundle-Sha256']
+
+        self.assertEqual(200, requests.head(f'http://localhost:5000/job_bundle/{sha256}').status_code)
+        self.assertEqual(404, requests.head(f'http://localhost:5000/job_bundle/{"0" * 64}').status_code)
+
+        response = requests.put(f'http://localhost:5000/job_bundle/{sha256}/jobs/{uuid.uuid4()}')
+        self.assertEqual(201, response.status_code)
+
+    def test_can_stream_bundle_as_request_body(self):
+        import os
+        import requests
+
+        tarball_location = self._generate_tarball()
+
+        with open(tarball_location, 'rb') as tarball:
+            response = requests.put(f'http://localhost:5000/job_bundle/{self.job_id}', data=tarball)
+
+        os.remove(tarball_location)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('Job bundle uploaded', response.text)
+
+    def _tar_bytes(self, members, mode='w'):
+        import io
+        import tarfile
+
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode=mode) as tar:
+            for member, content in members:
+                tar.addfile(member, io.BytesIO(content) if content is not None else None)
+        return buffer.getvalue()
+
+    def _file_member(self, name, content=b'hello world'):
+        import tarfile
+
+        member = tarfile.TarInfo(name)
+        member.size = len(content)
+        return member, content
+
+    def _link_member(self, name, target, link_type):
+        import tarfile
+
+        member = tarfile.TarInfo(name)
+        member.type = link_type
+        member.linkname = target
+        return member, None
+
+    def _upload_and_extract(self, bundle):
+        import os.path as path
+        import requests
+        from local_docker_scheduler.job_bundle_store import JobBundleStore
+
+        response = requests.put(f'http://localhost:5000/job_bundle/{self.job_id}', data=bundle)
+        self.assertEqual(200, response.status_code)
+
+        JobBundleStore(self.job_bundle_store_dir_path, self.working_dir_path).extract(self.job_id)
+        return path.join(self.working_dir_path, self.job_id)
+
+    def test_bundle_members_outside_of_the_working_directory_are_not_extracted(self):
+        import gzip
+        import os.path as path
+        import tarfile
+        import uuid
+
+        escaped = [f'/tmp/escape_{name}_{uuid.uuid4().hex}' for name in ('dotdot', 'absolute', 'symlink', 'hardlink')]
+        to_root = '../' * 16
+
+        bundle = gzip.compress(self._tar_bytes([
+            self._file_member(f'{self.job_id}/file_0'),
+            self._file_member(f'{self.job_id}/{to_root}{escaped[0][1:]}'),
+            self._file_member(escaped[1]),
+            self._link_member(f'{self.job_id}/escape', f'{to_root}tmp', tarfile.SYMTYPE),
+            self._file_member(f'{self.job_id}/escape/{path.basename(escaped[2])}'),
+            self._link_member(f'{self.job_id}/passwd', '/etc/passwd', tarfile.LNKTYPE),
+            self._link_member(f'{self.job_id}/{to_root}{escaped[3][1:]}', f'{self.job_id}/file_0', tarfile.LNKTYPE),
+        ]))
+
+        working_dir = self._upload_and_extract(bundle)
+
+        with open(path.join(working_dir, 'file_0')) as file_0:
+            self.assertEqual('hello world', file_0.read())
+        for escaped_path in escaped:
+            self.assertFalse(path.lexists(escaped_path), escaped_path)
+        self.assertFalse(path.islink(path.join(working_dir, 'escape')))
+        self.assertFalse(path.lexists(path.join(working_dir, 'passwd')))
+
+    def test_can_extract_uncompressed_bundle(self):
+        import os.path as path
+
+        working_dir = self._upload_and_extract(self._tar_bytes([self._file_member(f'{self.job_id}/file_0')]))
+
+        with open(path.join(working_dir, 'file_0')) as file_0:
+            self.assertEqual('hello world', file_0.read())
+
+    def test_can_extract_zstd_bundle(self):
+        import os.path as path
+
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest('compressing the test bundle needs the zstandard package')
+
+        bundle = zstandard.ZstdCompressor().compress(self._tar_bytes([self._file_member(f'{self.job_id}/file_0')]))
+        working_dir = self._upload_and_extract(bundle)
+
+        with open(path.join(working_dir, 'file_0')) as file_0:
+            self.assertEqual('hello world', file_0.read())
+
+    def test_removing_bundles_keeps_blobs_that_other_jobs_link_to(self):
+        import os.path as path
+        import uuid
+        import requests
+        from local_docker_scheduler.job_bundle_store import JobBundleStore
+
+        bundle = self._tar_bytes([self._file_member(f'{self.job_id}/file_0')])
+        other_job_id = str(uuid.uuid4())
+        for job_id in (self.job_id, other_job_id):
+            self.assertEqual(200, requests.put(f'http://localhost:5000/job_bundle/{job_id}', data=bundle).status_code)
+
+        store = JobBundleStore(self.job_bundle_store_dir_path, self.working_dir_path)
+        store.extract(self.job_id)
+        sha256 = store._sha256_of(self.job_id)
+        extracted_path = path.join(self.job_bundle_store_dir_path, 'extracted', sha256)
+
+        store.remove(self.job_id)
+        self.assertFalse(path.lexists(store.bundle_path(self.job_id)))
+        self.assertTrue(store.has_blob(sha256))
+        self.assertTrue(path.isdir(extracted_path))
+
+        store.remove(other_job_id)
+        self.assertFalse(store.has_blob(sha256))
+        self.assertFalse(path.isdir(extracted_path))
@@ -1,10 +1,33 @@
 from abc import ABC, abstractmethod
+from copy import deepcopy
 from importlib import import_module
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+import logging
+import os
+import time
+
+
+# 'sync' calls every plugin in the calling thread; 'async' queues the events and a background thread sends them in
+# batches so that a slow tracker does not hold up job submission or job start
+_tracker_mode = os.environ.get('TRACKER_MODE', 'sync')
+_queue_size = int(os.environ.get('TRACKER_QUEUE_SIZE', 10000))
+_batch_size = int(os.environ.get('TRACKER_BATCH_SIZE', 100))
+# 'drop' discards new events while the queue is full, 'block' waits up to TRACKER_BLOCK_TIMEOUT seconds for room
+_queue_full_policy = os.environ.get('TRACKER_QUEUE_FULL_POLICY', 'drop')
+_block_timeout = float(os.environ.get('TRACKER_BLOCK_TIMEOUT', 1))
+_max_retries = int(os.environ.get('TRACKER_MAX_RETRIES', 3))
+_retry_delay = float(os.environ.get('TRACKER_RETRY_DELAY', 1))
+
+
 class TrackerClientBase(ABC):
     @abstractmethod
     def queued(self, job):
         pass
 
+    def queued_many(self, jobs):
+        return [self.queued(job) for job in jobs]
+
     @abstractmethod
     def running(self, job):
         pass
@@ -29,23 +52,51 @@ class TrackerClientBase(ABC):
     def track_scheduled_job_run(self, job, run):
         pass
 
+    def track_many(self, events):
+        # events are (method name, args, time of the event); plugins can override this to send a batch at once
+        for method, args, event_time in events:
+            getattr(self, method)(*args)
+
+
 class _TrackerClientList(TrackerClientBase):
     def __init__(self):
         self._clients = []
+        self._events = Queue(maxsize=_queue_size)
+        self._flusher = None
+        self._metrics_lock = Lock()
+        self._metrics = {'enqueued': 0, 'sent': 0, 'dropped': 0, 'retried': 0, 'failed_batches': 0,
+                         'max_queue_depth': 0}
 
     def queued(self, job):
+        if _tracker_mode == 'async':
+            return self._enqueue('queued', job)
         return [client.queued(job) for client in self._clients]
 
+    def queued_many(self, jobs):
+        if _tracker_mode == 'async':
+            for job in jobs:
+                self._enqueue('queued', job)
+            return
+        return [client.queued_many(jobs) for client in self._clients]
+
     def running(self, job):
+        if _tracker_mode == 'async':
+            return self._enqueue('running', job)
         return [client.running(job) for client in self._clients]
 
     def completed(self, job):
+        if _tracker_mode == 'async':
+            return self._enqueue('completed', job)
         return [client.completed(job) for client in self._clients]
 
     def failed(self, job):
+        if _tracker_mode == 'async':
+            return self._enqueue('failed', job)
         return [client.failed(job) for client in self._clients]
 
     def delete(self, job):
+        if _tracker_mode == 'async':
+            return self._enqueue('delete', job)
         return [client.delete(job) for client in self._clients]
 
     def add(self, name, *args, **kwargs):
@@ -53,11 +104,91 @@ class _TrackerClientList(TrackerClientBase):
         self._clients.append(getattr(import_module('.'.join([__name__, name])), camel_name)(*args, **kwargs))
 
     def create_project(self, job):
+        if _tracker_mode == 'async':
+            return self._enqueue('create_project', job)
         return [client.create_project(job) for client in self._clients]
 
     def track_scheduled_job_run(self, job, run):
+        if _tracker_mode == 'async':
+            return self._enqueue('track_scheduled_job_run', job, run)
         return [client.track_scheduled_job_run(job, run) for client in self._clients]
 
+    def start(self):
+        if _tracker_mode != 'async' or self._flusher is not None:
+            return
+        self._flusher = Thread(target=self._flush_loop, name='tracker-flusher', daemon=True)
+        self._flusher.start()
+
+    def _count(self, metric, amount=1):
+        with self._metrics_lock:
+            self._metrics[metric] += amount
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {**self._metrics, 'queue_depth': self._events.qsize(), 'queue_size': _queue_size}
+
+    def _enqueue(self, method, *args):
+        # the event is sent later, so it must not see changes made to the job afterwards
+        event = (method, deepcopy(args), time.time())
+        try:
+            if _queue_full_policy == 'block':
+                self._events.put(event, timeout=_block_timeout)
+            else:
+                self._events.put_nowait(event)
+        except Full:
+            self._count('dropped')
+            logging.warning(f"Tracker queue is full; dropping {method} event")
+            return
+
+        depth = self._events.qsize()
+        with self._metrics_lock:
+            self._metrics['enqueued'] += 1
+            self._metrics['max_queue_depth'] = max(self._metrics['max_queue_depth'], depth)
+
+    def _next_batch(self, timeout=None):
+        try:
+            batch = [self._events.get(timeout=timeout)]
+        except Empty:
+            return []
+        while len(batch) < _batch_size:
+            try:
+                batch.append(self._events.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _flush_loop(self):
+        while True:
+            self._send(self._next_batch())
+
+    def _send(self, batch):
+        # every plugin is retried on its own so that one failing tracker does not resend the batch to the others
+        for client in self._clients:
+            for attempt in range(_max_retries + 1):
+                try:
+                    client.track_many(batch)
+                    self._count('sent', len(batch))
+                    break
+                except Exception as error:
+                    if attempt == _max_retries:
+                        self._count('failed_batches')
+                        self._count('dropped', len(batch))
+                        logging.error(f"Dropping {len(batch)} tracker events after {attempt + 1} attempts: {error}")
+                    else:
+                        self._count('retried')
+                        time.sleep(_retry_delay * 2 ** attempt)
+        for _ in batch:
+            self._events.task_done()
+
+    def flush(self, timeout=5):
+        # sends whatever is still queued, e.g. at shut down; no-op in sync mode
+        deadline = time.time() + timeout
+        while self._events.unfinished_tasks and time.time() < deadline:
+            if self._flusher is None:
+                self._send(self._next_batch(timeout=0))
+            else:
+                time.sleep(0.05)
+
 
 tracker_clients = _TrackerClientList()
 del _TrackerClientList
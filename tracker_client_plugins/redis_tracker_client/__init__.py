@@ -1,7 +1,12 @@
 from tracker_client_plugins import TrackerClientBase
+from tracker_client_plugins.redis_tracker_client.spool import EventSpool
+from db.redis_connection import connect
+from local_docker_scheduler.constants import _TRACKER_SPOOL_DIR
+from threading import Lock, Thread
 import redis
 import time
 import logging
+import os
 
 
 class RedisTrackerClient(TrackerClientBase):
@@ -14,11 +19,26 @@ class RedisTrackerClient(TrackerClientBase):
     # key-value jobs:<job_id>:(state/project_name/user/create_time/start_time/completed_time)
     # Z   projects <time> <project_id>
 
-    def __init__(self, host, port):
+    _UPDATE_TIME_FIELDS = {'queued': 'creation_time', 'running': 'start_time', 'completed': 'completed_time',
+                           'failed': 'completed_time'}
+
+    def __init__(self, host, port, failure_threshold=3, reset_timeout=30, spool_path=None, unix_socket=None):
         self._host = host
         self._port = port
-        self._rc = redis.StrictRedis(host=host, port=port)
+        self._rc = connect(host, port, unix_socket=unix_socket)
         self._logger = logging.getLogger(__name__)
+
+        # after failure_threshold consecutive failures the tracker is not contacted for reset_timeout seconds;
+        # updates made in the meantime are spooled to disk and replayed in order once a call succeeds again
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = Lock()
+        self._sending = False
+        self._spool = EventSpool(spool_path or os.path.join(_TRACKER_SPOOL_DIR, f'{host}_{port}.jsonl'))
+        Thread(target=self._replay_periodically, daemon=True).start()
+
         try:
             self._rc.ping()
             self._logger.info(f"Connected to Redis tracker at {host}:{port}")
@@ -48,11 +68,8 @@ class RedisTrackerClient(TrackerClientBase):
         for field, value in fields.items():
             p.set(f"jobs:{job_id}:{field}", value)
 
-    def _send_update(self, job: dict, status: str, relevant_time: dict, update_project_listing=False):
+    def _add_update(self, p: redis.Redis.pipeline, job: dict, status: str, relevant_time: dict, update_project_listing=False):
         job_id, project_name, username = job['job_id'], job['metadata']['project_name'], job['metadata']['username']
-        self._logger.debug(f"Tracking start: Update job {job_id} to {status}")
-
-        p = self._rc.pipeline()
 
         self._set_project_job_status(p, job_id, project_name, status)
         self._set_global_job_status(p, job_id, status)
@@ -60,33 +77,11 @@ class RedisTrackerClient(TrackerClientBase):
         self._kv_job(p, job_id, {**{'state': status, 'project': project_name, 'user': username}, **relevant_time})
 
         if update_project_listing:
-            if self.create_project(project_name, list(relevant_time.values())[0]):
-                self._logger.debug(f"Created project {project_name}")
+            p.zadd("projects", {project_name: list(relevant_time.values())[0]}, nx=True)
 
-        try:
-            p.execute()
-        except redis.exceptions.ConnectionError:
-            self._logger.warning(f"Cannot connect to Redis tracker at {self._host}:{self._port}")
-
-        self._logger.debug(f"Tracking end: Update job {job_id} to {status}")
-
-    def queued(self, job):
-        self._send_update(job, "queued", {'creation_time': time.time()}, True)
-
-    def running(self, job):
-        self._send_update(job, "running", {'start_time': time.time()}, False)
-
-    def completed(self, job):
-        self._send_update(job, "completed", {'completed_time': time.time()}, False)
-
-    def failed(self, job):
-        self._send_update(job, "failed", {'completed_time': time.time()}, False)
-
-    def delete(self, job):
+    @staticmethod
+    def _add_delete(p: redis.Redis.pipeline, job: dict):
         job_id, project_name = job['job_id'], job['metadata']['project_name']
-        self._logger.debug(f"Tracking start: Deleting job {job_id}")
-
-        p = self._rc.pipeline()
 
         states = ['queued', 'running', 'completed']
         project_keys = [f"project:{project_name}:jobs:{i}" for i in states]
@@ -104,19 +99,114 @@ class RedisTrackerClient(TrackerClientBase):
 
         p.delete(*jobs_keys)
 
+    def _send(self, events):
+        self._logger.debug(f"Tracking start: Sending {len(events)} events")
+
+        p = self._rc.pipeline()
+        for method, args, event_time in events:
+            try:
+                self._add_event(p, method, args, event_time)
+            except (KeyError, TypeError, IndexError) as error:
+                # a malformed job would otherwise block every event spooled after it
+                self._logger.error(f"Skipping malformed tracker event {method}: {error}")
         p.execute()
 
-        self._logger.debug(f"Tracking end: Deleting job {job_id}")
+        self._logger.debug(f"Tracking end: Sending {len(events)} events")
+
+    def _add_event(self, p: redis.Redis.pipeline, method: str, args: list, event_time: float):
+        if method in self._UPDATE_TIME_FIELDS:
+            self._add_update(p, args[0], method, {self._UPDATE_TIME_FIELDS[method]: event_time}, method == 'queued')
+        elif method == 'delete':
+            self._add_delete(p, args[0])
+        elif method == 'create_project':
+            p.zadd("projects", {args[0]: event_time}, nx=True)
+        elif method == 'track_scheduled_job_run':
+            job, run = args
+            p.sadd(f'projects:{job["metadata"]["project_name"]}:monitors:{job["metadata"]["monitor_name"]}:jobs', run)
+
+    def _circuit_open(self):
+        if self._opened_at is None:
+            return False
+        # once reset_timeout has passed, the next call goes through as a trial
+        return time.time() - self._opened_at < self._reset_timeout
+
+    def _record_failure(self, error):
+        self._failures += 1
+        if self._failures >= self._failure_threshold:
+            if self._opened_at is None:
+                self._logger.warning(f"Redis tracker at {self._host}:{self._port} is unavailable; spooling updates: {error}")
+            self._opened_at = time.time()
+        else:
+            self._logger.warning(f"Cannot connect to Redis tracker at {self._host}:{self._port}: {error}")
+
+    def _record_success(self):
+        if self._opened_at is not None:
+            self._logger.info(f"Redis tracker at {self._host}:{self._port} is available again")
+        self._failures = 0
+        self._opened_at = None
+
+    def _track(self, events):
+        # the lock only guards the breaker and the spool; the events are sent without it
+        with self._lock:
+            if self._circuit_open() or self._sending:
+                # replayed after the events being sent, by the next call or the replay thread
+                self._spool.append(events)
+                return
+            replay = bool(self._spool)
+            if replay:
+                # spooled events are older, so they go first
+                self._spool.append(events)
+            self._sending = True
 
-    def create_project(self, project_name, project_creation_time=None):
-        if not project_creation_time:
-            project_creation_time = time.time()
+        try:
+            if replay:
+                self._spool.replay(self._send)
+            else:
+                self._send(events)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as error:
+            with self._lock:
+                if not replay:
+                    self._spool.append(events)
+                self._record_failure(error)
+        else:
+            with self._lock:
+                self._record_success()
+        finally:
+            with self._lock:
+                self._sending = False
+
+    def _replay_periodically(self):
+        while True:
+            time.sleep(self._reset_timeout)
+            if self._spool and not self._circuit_open():
+                self._track([])
+
+    def track_many(self, events):
+        # failures are spooled rather than raised, so batches are never retried by the caller
+        self._track(list(events))
 
-        return self._rc.zadd("projects", {project_name: project_creation_time}, nx=True)
+    def queued(self, job):
+        self._track([('queued', [job], time.time())])
 
-    def track_scheduled_job_run(self, job, run):
-        project_name = job['metadata']['project_name']
-        monitor_name = job['metadata']['monitor_name']
-        self._logger.debug(f'Tracking run {run} for job {job["job_id"]} in project {project_name}')
-        self._rc.sadd(f'projects:{project_name}:monitors:{monitor_name}:jobs', run)
+    def queued_many(self, jobs):
+        creation_time = time.time()
+        self._track([('queued', [job], creation_time) for job in jobs])
+
+    def running(self, job):
+        self._track([('running', [job], time.time())])
 
+    def completed(self, job):
+        self._track([('completed', [job], time.time())])
+
+    def failed(self, job):
+        self._track([('failed', [job], time.time())])
+
+    def delete(self, job):
+        self._track([('delete', [job], time.time())])
+
+    def create_project(self, project_name, project_creation_time=None):
+        self._track([('create_project', [project_name], project_creation_time or time.time())])
+
+    def track_scheduled_job_run(self, job, run):
+        self._logger.debug(f'Tracking run {run} for job {job["job_id"]} in project {job["metadata"]["project_name"]}')
+        self._track([('track_scheduled_job_run', [job, run], time.time())])
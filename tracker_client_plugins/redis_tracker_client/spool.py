@@ -0,0 +1,55 @@
+import json
+import os
+from threading import Lock
+
+
+class EventSpool:
+    # tracker events that could not be sent, one json line per (method, args, event time), in the order they happened
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        self._lock = Lock()
+
+    def __bool__(self):
+        with self._lock:
+            return os.path.exists(self._path) and os.path.getsize(self._path) > 0
+
+    def append(self, events):
+        with self._lock:
+            with open(self._path, 'a') as f:
+                for method, args, event_time in events:
+                    f.write(json.dumps([method, args, event_time], default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def replay(self, send, batch_size=500):
+        # sends the spooled events in order without holding the lock, so events can be appended meanwhile; whatever
+        # could not be sent is kept in front of them for the next replay. Only one replay may run at a time
+        with self._lock:
+            events = self._read()
+
+        sent = 0
+        try:
+            while sent < len(events):
+                batch = events[sent:sent + batch_size]
+                send(batch)
+                sent += len(batch)
+        finally:
+            if sent:
+                with self._lock:
+                    self._rewrite(events[sent:] + self._read()[len(events):])
+        return sent
+
+    def _read(self):
+        try:
+            with open(self._path) as f:
+                return [tuple(json.loads(line)) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _rewrite(self, events):
+        temporary_path = self._path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            for method, args, event_time in events:
+                f.write(json.dumps([method, args, event_time], default=str) + '\n')
+        os.replace(temporary_path, self._path)